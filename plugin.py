@@ -6,7 +6,14 @@
     Unofficial Spotify client for Kodi
 """
 
-from resources.lib.plugin_content import PluginContent
+import sys
+import time
 
 if __name__ == "__main__":
+    # With 'reuselanguageinvoker', the plugin may still be loaded from an earlier invocation.
+    is_cold_start = "resources.lib.plugin_content" not in sys.modules
+    import_start_time = time.perf_counter()
+    from resources.lib.plugin_content import PluginContent, log_import_time
+
+    log_import_time(time.perf_counter() - import_start_time, is_cold_start)
     PluginContent()
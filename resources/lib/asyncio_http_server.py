@@ -0,0 +1,366 @@
+import asyncio
+import io
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+from wsgiref.handlers import format_date_time
+
+from xbmc import LOGDEBUG
+
+from http_connection_stats import ConnectionStats
+from utils import log_msg, log_exception
+
+MAX_REQUEST_HEAD_BYTES = 65536
+MAX_REQUEST_BODY_BYTES = 1048576
+# Threads for the blocking parts: calling the app, and waiting for the next part of a body.
+# A stream waiting for its decoder holds one of these in 'read' until audio arrives, so
+# like the wsgiref audio lane's workers, they also limit how many streams can wait at once.
+# A stream whose audio is already buffered only holds one for a moment per block.
+MAX_BLOCKING_WORKERS = 16
+# A stream's writes wait in 'drain' while more than this is queued for its client.
+WRITE_BUFFER_HIGH_WATER_BYTES = 1048576
+HANG_UP_CHECK_INTERVAL_IN_SECS = 0.5
+SHUTDOWN_GRACE_IN_SECS = 2.0
+START_TIMEOUT_IN_SECS = 5.0
+
+
+class AsyncioFileWrapper:
+    """'wsgi.file_wrapper' keeping hold of a file-like body, so the server can stream it."""
+
+    def __init__(self, filelike, block_size: int):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+    def close(self) -> None:
+        if hasattr(self.filelike, "close"):
+            self.filelike.close()
+
+
+class HttpRequest:
+    def __init__(self, method: str, target: str, version: str, headers: List[Tuple[str, str]]):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def get_header(self, name: str) -> str:
+        return ",".join(value for key, value in self.headers if key.lower() == name.lower())
+
+    def wants_keep_alive(self) -> bool:
+        connection = self.get_header("Connection").lower()
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+
+class AsyncioHttpServer:
+    """Serves a WSGI app from a single event loop thread, with HTTP/1.1 keep-alive. Only the
+    blocking parts run on worker threads. A slow client holds no thread: its stream waits in
+    'drain' until the client has taken what was already sent."""
+
+    def __init__(
+        self,
+        app: Callable,
+        host: str,
+        port: int,
+        idle_timeout_in_secs: float,
+        block_size: int,
+        connection_stats: ConnectionStats,
+    ):
+        self.__app = app
+        self.__host = host
+        self.__port = port
+        self.__idle_timeout_in_secs = idle_timeout_in_secs
+        self.__block_size = block_size
+        self.__connection_stats = connection_stats
+
+        self.__executor = ThreadPoolExecutor(MAX_BLOCKING_WORKERS, "asyncio-http")
+        self.__loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.__stopping: Union[asyncio.Event, None] = None
+        self.__started = threading.Event()
+        self.__connection_tasks = set()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self) -> None:
+        self.__thread.start()
+        self.__started.wait(START_TIMEOUT_IN_SECS)
+
+    def stop(self) -> None:
+        """Stops taking connections, gives open ones a moment to finish, then ends them."""
+        log_msg("Shutdown asyncio server requested...")
+        if self.__loop and self.__stopping:
+            self.__loop.call_soon_threadsafe(self.__stopping.set)
+        self.__thread.join()
+        self.__executor.shutdown(wait=False)
+
+    def __run(self) -> None:
+        try:
+            asyncio.run(self.__serve())
+        except Exception as exc:
+            log_exception(exc, "Asyncio server stopped with exception")
+        finally:
+            self.__started.set()
+
+    async def __serve(self) -> None:
+        self.__loop = asyncio.get_running_loop()
+        self.__stopping = asyncio.Event()
+        server = await asyncio.start_server(
+            self.__handle_connection, self.__host, self.__port, limit=MAX_REQUEST_HEAD_BYTES
+        )
+        log_msg(f"Started asyncio web server on {self.__host}:{self.__port}.")
+        self.__started.set()
+
+        await self.__stopping.wait()
+        server.close()
+        if self.__connection_tasks:
+            _, pending = await asyncio.wait(self.__connection_tasks, timeout=SHUTDOWN_GRACE_IN_SECS)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        log_msg("Asyncio web server stopped.", LOGDEBUG)
+
+    async def __handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        self.__connection_tasks.add(task)
+        self.__connection_stats.add_connection()
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH_WATER_BYTES)
+        request_count = 0
+        try:
+            while not self.__stopping.is_set():
+                request = await self.__read_request(reader)
+                if not request:
+                    break
+                self.__connection_stats.add_request(request_count > 0)
+                request_count += 1
+                if not await self.__respond(reader, writer, request):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by 'stop', once the body is closed. Ending normally, as asyncio's
+            # stream callback logs a cancelled connection task as an error.
+            pass
+        except Exception as exc:
+            log_exception(exc, "Error serving HTTP connection")
+        finally:
+            self.__connection_tasks.discard(task)
+            writer.close()
+            log_msg(f"Closed connection after {request_count} request(s).", LOGDEBUG)
+
+    async def __read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Union[Tuple[HttpRequest, bytes], None]:
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), self.__idle_timeout_in_secs
+            )
+        except asyncio.TimeoutError:
+            self.__connection_stats.add_idle_timeout()
+            return None
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return None
+
+        lines = head.decode("iso-8859-1").split("\r\n")
+        request_line = lines[0].split()
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/"):
+            return None
+        headers = []
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(":")
+                headers.append((name.strip(), value.strip()))
+        request = HttpRequest(request_line[0].upper(), request_line[1], request_line[2], headers)
+
+        # Anything but a plain, small body would need more than this server offers.
+        if request.get_header("Transfer-Encoding"):
+            return None
+        body_len = int(request.get_header("Content-Length") or 0)
+        if body_len > MAX_REQUEST_BODY_BYTES:
+            return None
+        body = await reader.readexactly(body_len) if body_len else bytes()
+        return request, body
+
+    async def __respond(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        request_and_body: Tuple[HttpRequest, bytes],
+    ) -> bool:
+        """Returns True if the connection can take another request."""
+        request, body = request_and_body
+        loop = asyncio.get_running_loop()
+        response_start: List[Any] = []
+
+        def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None):
+            response_start[:] = [status, headers]
+            return lambda data: None
+
+        environ = self.__make_environ(request, body, writer)
+        call_app = loop.run_in_executor(self.__executor, self.__app, environ, start_response)
+        try:
+            result = await self.__wait_for_blocking_call(call_app)
+        except asyncio.CancelledError:
+            # The app still answered, and its body may hold a stream session.
+            if not call_app.cancelled() and not call_app.exception():
+                await loop.run_in_executor(self.__executor, self.__close_result, call_app.result())
+            raise
+        try:
+            status, headers = response_start
+            keep_alive = request.wants_keep_alive()
+            content_length = self.__get_content_length(headers, result)
+            if content_length is None:
+                keep_alive = False
+                headers.append(("Connection", "close"))
+            elif keep_alive and request.version == "HTTP/1.0":
+                headers.append(("Connection", "keep-alive"))
+
+            writer.write(self.__make_response_head(status, headers))
+            if request.method == "HEAD":
+                await writer.drain()
+                return keep_alive
+
+            if isinstance(result, AsyncioFileWrapper):
+                bytes_sent = await self.__send_file_like(reader, writer, result.filelike)
+            else:
+                bytes_sent = await self.__send_iterable(writer, result)
+            return keep_alive and bytes_sent == content_length
+        finally:
+            await loop.run_in_executor(self.__executor, self.__close_result, result)
+
+    async def __send_file_like(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, filelike
+    ) -> int:
+        loop = asyncio.get_running_loop()
+        bytes_sent = 0
+        while True:
+            read = loop.run_in_executor(self.__executor, filelike.read, self.__block_size)
+            data = await self.__wait_unless_hung_up(reader, writer, read, filelike)
+            if not data:
+                return bytes_sent
+            writer.write(data)
+            # Backpressure: wait here while the client is behind, holding no thread.
+            await writer.drain()
+            bytes_sent += len(data)
+
+    async def __send_iterable(self, writer: asyncio.StreamWriter, result: Iterable) -> int:
+        loop = asyncio.get_running_loop()
+        bytes_sent = 0
+        iterator = iter(result)
+        while True:
+            if isinstance(result, (list, tuple)):
+                data = next(iterator, None)
+            else:
+                # Getting the next block of a generator may block, so do it on a worker.
+                data = await self.__wait_for_blocking_call(
+                    loop.run_in_executor(self.__executor, next, iterator, None)
+                )
+            if data is None:
+                return bytes_sent
+            writer.write(data)
+            await writer.drain()
+            bytes_sent += len(data)
+
+    @staticmethod
+    def __close_result(result: Iterable) -> None:
+        if hasattr(result, "close"):
+            result.close()
+
+    @staticmethod
+    async def __wait_for_blocking_call(call: asyncio.Future) -> Any:
+        """Wait for a call on a worker thread. If this task is cancelled meanwhile, e.g. on
+        shutdown, the call goes on running. So wait for it to end before anything else, like
+        closing the body, touches what it's using."""
+        try:
+            return await asyncio.shield(call)
+        except asyncio.CancelledError:
+            await asyncio.wait({call})
+            raise
+
+    @staticmethod
+    async def __wait_unless_hung_up(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter, read: asyncio.Future, filelike
+    ) -> bytes:
+        """Wait for the next part of a body, cancelling the body if the client hangs up
+        meanwhile, e.g. while a stream waits for its decoder."""
+        cancel = getattr(filelike, "cancel", None)
+        while True:
+            try:
+                done, _ = await asyncio.wait({read}, timeout=HANG_UP_CHECK_INTERVAL_IN_SECS)
+            except asyncio.CancelledError:
+                # As in '__wait_for_blocking_call', but a stream waiting for audio is woken
+                # first. The read is inside the body's generator, which can't be closed
+                # while it runs.
+                if cancel:
+                    cancel()
+                await asyncio.wait({read})
+                raise
+            if done:
+                return read.result()
+            if reader.at_eof() or writer.is_closing():
+                log_msg("Stream client hung up.", LOGDEBUG)
+                if cancel:
+                    cancel()
+                await read
+                return bytes()
+
+    def __make_environ(
+        self, request: HttpRequest, body: bytes, writer: asyncio.StreamWriter
+    ) -> Dict[str, Any]:
+        path, _, query = request.target.partition("?")
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote(path, "iso-8859-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.__host,
+            "SERVER_PORT": str(self.__port),
+            "SERVER_PROTOCOL": request.version,
+            "REMOTE_ADDR": peer[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": lambda filelike, block_size=self.__block_size: (
+                AsyncioFileWrapper(filelike, block_size)
+            ),
+        }
+        for name, value in request.headers:
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    @staticmethod
+    def __get_content_length(headers: List[Tuple[str, str]], result: Iterable) -> Union[int, None]:
+        for name, value in headers:
+            if name.lower() == "content-length":
+                return int(value)
+        # As wsgiref does: a single block body has a known length.
+        if isinstance(result, (list, tuple)) and len(result) == 1:
+            headers.append(("Content-Length", str(len(result[0]))))
+            return len(result[0])
+        return None
+
+    @staticmethod
+    def __make_response_head(status: str, headers: List[Tuple[str, str]]) -> bytes:
+        lines = [f"HTTP/1.1 {status}", f"Date: {format_date_time(time.time())}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
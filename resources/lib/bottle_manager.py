@@ -1,14 +1,39 @@
 import socket
-import socketserver
 import threading
-from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from typing import Dict, Tuple, Union
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
 from wsgiref.simple_server import make_server
+from wsgiref.util import FileWrapper
 
 import bottle
+from asyncio_http_server import AsyncioHttpServer
 from bottle import Bottle
+from http_connection_stats import ConnectionStats
+from http_worker_pool import ConnectionDispatcher, HttpWorkerPool
+from http_worker_pool import REQUEST_PEEK_LEN, get_request_path
 from utils import log_msg, log_exception, LOGDEBUG
 
 STREAMING_TIMEOUT_IN_SECS = 600
+# How long a persistent connection may wait for its next request before it's closed.
+KEEP_ALIVE_IDLE_TIMEOUT_IN_SECS = 15
+# Block size used when a file-like response has to be sent by reading it.
+FILE_WRAPPER_BLOCK_SIZE = 524288
+
+# Connections are served by a worker pool per lane, picked by the path of a connection's
+# first request. Audio streams have their own lane, so other requests can't starve them.
+AUDIO_LANE = "audio"
+DEFAULT_LANE = "default"
+# Lane -> (max workers, max connections waiting for a worker).
+LANE_POOL_SIZES = {
+    AUDIO_LANE: (8, 16),
+    DEFAULT_LANE: (4, 32),
+}
+SERVICE_UNAVAILABLE_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+)
+
+# Route path prefix -> lane, for routes not in the default lane.
+__lane_path_prefixes: Dict[str, str] = dict()
 
 
 def __bottle_stderr(*args):
@@ -18,8 +43,145 @@ def __bottle_stderr(*args):
 bottle._stderr = __bottle_stderr
 
 
-class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
-    pass
+def get_lane(path: str) -> str:
+    for prefix, lane in __lane_path_prefixes.items():
+        if path.startswith(prefix):
+            return lane
+    return DEFAULT_LANE
+
+
+__connection_stats = ConnectionStats()
+
+
+def get_connection_stats() -> ConnectionStats:
+    return __connection_stats
+
+
+class PooledWSGIServer(WSGIServer):
+    """Serves connections from bounded worker pools instead of a new thread for each."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__pools = {
+            lane: HttpWorkerPool(lane, max_workers, max_backlog)
+            for lane, (max_workers, max_backlog) in LANE_POOL_SIZES.items()
+        }
+        self.__lock = threading.Lock()
+        self.__connection_pools: Dict[socket.socket, HttpWorkerPool] = dict()
+        self.__dispatcher = ConnectionDispatcher(
+            self.__dispatch, self.__time_out, KEEP_ALIVE_IDLE_TIMEOUT_IN_SECS
+        )
+
+    def process_request(self, request: socket.socket, client_address: Tuple) -> None:
+        self.__dispatcher.add(request, client_address)
+
+    def set_connection_idle(self, connection: socket.socket) -> None:
+        """While idle, the connection may be closed to free its worker."""
+        pool = self.__get_pool(connection)
+        if pool:
+            pool.set_connection_idle(connection)
+
+    def set_connection_busy(self, connection: socket.socket) -> bool:
+        """Returns False if the connection was closed while idle."""
+        pool = self.__get_pool(connection)
+        return pool.set_connection_busy(connection) if pool else True
+
+    def get_connection_lane(self, connection: socket.socket) -> str:
+        pool = self.__get_pool(connection)
+        return pool.name if pool else DEFAULT_LANE
+
+    def server_close(self) -> None:
+        self.__dispatcher.stop()
+        for pool in self.__pools.values():
+            pool.stop()
+        super().server_close()
+
+    def __get_pool(self, connection: socket.socket) -> HttpWorkerPool:
+        with self.__lock:
+            return self.__connection_pools.get(connection)
+
+    def __dispatch(self, connection: socket.socket, client_address: Tuple, path: str) -> None:
+        pool = self.__pools[get_lane(path)]
+        with self.__lock:
+            self.__connection_pools[connection] = pool
+        if pool.submit(lambda: self.__process(connection, client_address)):
+            return
+
+        with self.__lock:
+            del self.__connection_pools[connection]
+        log_msg(f"No '{get_lane(path)}' worker free for '{path}'. Rejecting the connection.")
+        get_connection_stats().add_rejected_connection()
+        try:
+            connection.sendall(SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(connection)
+
+    def __time_out(self, connection: socket.socket) -> None:
+        get_connection_stats().add_idle_timeout()
+        self.shutdown_request(connection)
+
+    # Same as 'socketserver.ThreadingMixIn.process_request_thread'.
+    def __process(self, connection: socket.socket, client_address: Tuple) -> None:
+        try:
+            self.finish_request(connection, client_address)
+        except Exception:
+            self.handle_error(connection, client_address)
+        finally:
+            with self.__lock:
+                self.__connection_pools.pop(connection, None)
+            self.shutdown_request(connection)
+
+
+class LargeBlockFileWrapper(FileWrapper):
+    def __init__(self, filelike, blksize: int = FILE_WRAPPER_BLOCK_SIZE):
+        super().__init__(filelike, blksize)
+
+
+class SendfileServerHandler(ServerHandler):
+    """Lets file-like responses with a 'send_to_socket' method write directly to the
+    client socket, e.g. with 'os.sendfile', instead of going through 'write'."""
+
+    wsgi_file_wrapper = LargeBlockFileWrapper
+    http_version = "1.1"
+    # Set once the whole response has gone out, framed so the connection can be reused.
+    keep_alive = False
+
+    def cleanup_headers(self) -> None:
+        super().cleanup_headers()
+        # Without a length the client can only find the end of the body by the connection
+        # closing.
+        if "Content-Length" not in self.headers:
+            self.headers["Connection"] = "close"
+        elif self.request_handler.request_version == "HTTP/1.0":
+            # HTTP/1.0 clients only keep a connection open when told so.
+            if not self.request_handler.close_connection:
+                self.headers["Connection"] = "keep-alive"
+
+    def close(self) -> None:
+        # The response state is gone after 'close', so decide about the connection first.
+        self.keep_alive = self.__is_response_complete()
+        super().close()
+
+    def __is_response_complete(self) -> bool:
+        if not self.headers_sent or not self.headers:
+            return False
+        if "close" in self.headers.get("Connection", "").lower():
+            return False
+        if self.environ.get("REQUEST_METHOD") == "HEAD":
+            return True
+        return self.headers.get("Content-Length") == str(self.bytes_sent)
+
+    def sendfile(self) -> bool:
+        send_to_socket = getattr(self.result.filelike, "send_to_socket", None)
+        if not send_to_socket:
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        self.bytes_sent = send_to_socket(self.request_handler.connection)
+        return True
 
 
 # Need this copy of 'bottle.WSGIRefServer' to add a 'shutdown' method, so we can do a
@@ -39,8 +201,90 @@ class MyWSGIRefServer(bottle.WSGIRefServer):
                 if not self.quiet:
                     return WSGIRequestHandler.log_request(*args, **kw)
 
+            # HTTP/1.1, so clients keep the connection open for their next request.
+            protocol_version = "HTTP/1.1"
+
+            def handle(self) -> None:
+                get_connection_stats().add_connection()
+                request_count = 0
+                self.close_connection = False
+                while not self.close_connection:
+                    if not self.handle_request(request_count > 0):
+                        break
+                    request_count += 1
+                log_msg(f"Closed connection after {request_count} request(s).", LOGDEBUG)
+
+            # Same as 'WSGIRequestHandler.handle', but with our own 'ServerHandler', and
+            # waiting at most the idle timeout for the request.
+            def handle_request(self, reused: bool) -> bool:
+                """Returns False if there was no request."""
+                if reused:
+                    self.server.set_connection_idle(self.connection)
+                try:
+                    self.connection.settimeout(KEEP_ALIVE_IDLE_TIMEOUT_IN_SECS)
+                    if reused and self.__is_for_other_lane():
+                        # Closed without an answer, as for any idle connection, so the client
+                        # retries on a new connection, which is dispatched to the right lane.
+                        self.server.set_connection_busy(self.connection)
+                        log_msg("Closing a connection whose next request is for another lane.")
+                        return False
+                    self.raw_requestline = self.rfile.readline(65537)
+                    # Back to blocking, which streaming the response with 'sendfile' needs.
+                    self.connection.settimeout(None)
+                except socket.timeout:
+                    get_connection_stats().add_idle_timeout()
+                    self.raw_requestline = bytes()
+                except OSError:
+                    self.raw_requestline = bytes()
+                if reused and not self.server.set_connection_busy(self.connection):
+                    # Closed while idle, to free this worker for another connection.
+                    return False
+                if not self.raw_requestline:
+                    return False
+
+                self.close_connection = True
+                if len(self.raw_requestline) > 65536:
+                    self.requestline = ""
+                    self.request_version = ""
+                    self.command = ""
+                    self.send_error(414)
+                    return True
+
+                if not self.parse_request():
+                    return True
+
+                get_connection_stats().add_request(reused)
+                handler = SendfileServerHandler(
+                    self.rfile,
+                    self.wfile,
+                    self.get_stderr(),
+                    self.get_environ(),
+                    multithread=False,
+                )
+                handler.request_handler = self
+                handler.run(self.server.get_app())
+
+                # 'parse_request' has set 'close_connection' from the request's version and
+                # headers. A request body the app may not have read would be taken for the
+                # next request, so such connections aren't reused either.
+                if not handler.keep_alive or self.__has_request_body():
+                    self.close_connection = True
+                return True
+
+            def __is_for_other_lane(self) -> bool:
+                # A peek, so the request stays buffered for reading if it's served here.
+                path = get_request_path(self.rfile.peek(REQUEST_PEEK_LEN))
+                return bool(path) and (
+                    get_lane(path) != self.server.get_connection_lane(self.connection)
+                )
+
+            def __has_request_body(self) -> bool:
+                return "Transfer-Encoding" in self.headers or (
+                    self.headers.get("Content-Length", "0") not in ("", "0")
+                )
+
         handler_cls = self.options.get("handler_class", FixedHandler)
-        server_cls = self.options.get("server_class", ThreadedWSGIServer)
+        server_cls = self.options.get("server_class", PooledWSGIServer)
 
         if ":" in self.host:
             # Fix wsgiref for IPv6 addresses.
@@ -66,27 +310,47 @@ class MyWSGIRefServer(bottle.WSGIRefServer):
     def shutdown(self) -> None:
         log_msg("Shutdown wsgiref server requested...")
         self.__server.shutdown()
+        # Stops the worker pools and closes the listening socket.
+        self.__server.server_close()
 
 
 __server: MyWSGIRefServer = MyWSGIRefServer()
+__asyncio_server: Union[AsyncioHttpServer, None] = None
 __bottle_manager: Bottle = Bottle()
 __manager_thread: threading.Thread = threading.Thread()
 
 
-def route_all(app: object) -> None:
+def route_all(app: object, lane: str = DEFAULT_LANE) -> None:
     for kw in dir(app):
         attr = getattr(app, kw)
         if hasattr(attr, "route"):
-            __bottle_manager.route(attr.route)(attr)
+            __bottle_manager.route(attr.route, getattr(attr, "method", "GET"))(attr)
+            if lane != DEFAULT_LANE:
+                __lane_path_prefixes[attr.route.split("<")[0]] = lane
 
 
 def __begin_app() -> None:
     bottle.run(app=__bottle_manager, server=__server)
 
 
-def start_thread(web_port: int) -> None:
+def start_thread(web_port: int, use_asyncio: bool = False) -> None:
+    """Serve the routes on 'web_port', from a wsgiref server with worker pools, or if
+    'use_asyncio', from a single asyncio event loop."""
     global __manager_thread
     global __server
+    global __asyncio_server
+    if use_asyncio:
+        __asyncio_server = AsyncioHttpServer(
+            __bottle_manager,
+            "localhost",
+            web_port,
+            KEEP_ALIVE_IDLE_TIMEOUT_IN_SECS,
+            FILE_WRAPPER_BLOCK_SIZE,
+            get_connection_stats(),
+        )
+        __asyncio_server.start()
+        return
+
     __server = MyWSGIRefServer(host="localhost", port=web_port)
     __manager_thread = threading.Thread(target=__begin_app)
     __manager_thread.start()
@@ -96,6 +360,9 @@ def stop_thread() -> None:
     log_msg("Closing bottle app and thread.", LOGDEBUG)
     try:
         __bottle_manager.close()
+        if __asyncio_server:
+            __asyncio_server.stop()
+            return
         __server.shutdown()
         __manager_thread.join()
     except Exception as exc:
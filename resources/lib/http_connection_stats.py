@@ -0,0 +1,41 @@
+import threading
+
+
+class ConnectionStats:
+    """Counts connections and the requests on them, to show how often clients reuse a
+    connection rather than open a new one."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__connections = 0
+        self.__requests = 0
+        self.__reused_requests = 0
+        self.__idle_timeouts = 0
+        self.__rejected_connections = 0
+
+    def add_connection(self) -> None:
+        with self.__lock:
+            self.__connections += 1
+
+    def add_request(self, reused: bool) -> None:
+        with self.__lock:
+            self.__requests += 1
+            if reused:
+                self.__reused_requests += 1
+
+    def add_idle_timeout(self) -> None:
+        with self.__lock:
+            self.__idle_timeouts += 1
+
+    def add_rejected_connection(self) -> None:
+        with self.__lock:
+            self.__rejected_connections += 1
+
+    def get_summary(self) -> str:
+        with self.__lock:
+            return (
+                f"{self.__connections} connection(s), {self.__requests} request(s),"
+                f" {self.__reused_requests} on a reused connection,"
+                f" {self.__idle_timeouts} idle timeout(s),"
+                f" {self.__rejected_connections} rejected connection(s)"
+            )
@@ -0,0 +1,37 @@
+import hmac
+import secrets
+from typing import Union
+
+import bottle
+from xbmc import LOGWARNING
+
+from utils import PROXY_PORT, SERVICE_SECRET_HEADER, log_msg, publish_service_secret
+
+
+class HTTPServiceAuth:
+    """Keeps the routes that hand out the Spotify token, or act with it, to this add-on's
+    own plugin invocations. They send back a secret the service publishes in a window
+    property for each session, which other local users and apps can't read. Requests for
+    any other host are refused too, so a web page can't reach the routes by DNS rebinding."""
+
+    def __init__(self, port: int = PROXY_PORT):
+        self.__host = f"localhost:{port}"
+        self.__secret = secrets.token_urlsafe(32)
+        publish_service_secret(self.__secret)
+
+    def close(self) -> None:
+        publish_service_secret("")
+
+    def check_request(self) -> Union[bottle.HTTPError, None]:
+        """An error response if the current request isn't from the plugin, else None."""
+        host = bottle.request.get_header("Host", "")
+        if host != self.__host:
+            log_msg(f"Refused '{bottle.request.path}' for host '{host}'.", LOGWARNING)
+            return bottle.HTTPError(403, "Forbidden.")
+
+        secret = bottle.request.get_header(SERVICE_SECRET_HEADER, "")
+        if not hmac.compare_digest(secret.encode(), self.__secret.encode()):
+            log_msg(f"Refused '{bottle.request.path}' without the service secret.", LOGWARNING)
+            return bottle.HTTPError(403, "Forbidden.")
+
+        return None
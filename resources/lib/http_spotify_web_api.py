@@ -0,0 +1,45 @@
+from typing import Any, Dict, Union
+
+import bottle
+import spotipy
+from http_service_auth import HTTPServiceAuth
+from spotify_web_api_gateway import SpotifyWebApiGateway
+from utils import log_msg, LOGDEBUG
+
+
+class HTTPSpotifyWebApi:
+    """Makes Spotify Web API calls for plugin invocations, through the service's gateway.
+    The request body is '{"method": ..., "args": [...], "kwargs": {...}}', the response
+    '{"result": ...}', or a JSON error with the Web API's status. Only the plugin may call
+    it, as it can change the user's library."""
+
+    def __init__(self, gateway: SpotifyWebApiGateway, service_auth: HTTPServiceAuth):
+        self.__gateway = gateway
+        self.__service_auth = service_auth
+
+    WEB_API_ROUTE = "/webapi"
+
+    def spotify_web_api(self) -> Union[Dict[str, Any], bottle.HTTPError]:
+        auth_error = self.__service_auth.check_request()
+        if auth_error:
+            return auth_error
+
+        call = bottle.request.json
+        if not call or "method" not in call:
+            bottle.response.status = 400
+            return {"error": "No Web API call given."}
+
+        bottle.response.headers["Cache-Control"] = "no-store"
+        try:
+            result = self.__gateway.call(
+                call["method"], call.get("args", []), call.get("kwargs", {})
+            )
+        except spotipy.SpotifyException as exc:
+            log_msg(f"Web API call '{call['method']}' failed: {exc}", LOGDEBUG)
+            bottle.response.status = exc.http_status if exc.http_status >= 400 else 502
+            return {"error": exc.msg, "code": exc.code}
+
+        return {"result": result}
+
+    spotify_web_api.route = WEB_API_ROUTE
+    spotify_web_api.method = "POST"
@@ -1,42 +1,69 @@
-import threading
-import time
-from typing import Callable
+from typing import Callable, List, Tuple, Union
 
 import bottle
 from spotty import Spotty
 from spotty_audio_streamer import SpottyAudioStreamer
+from spotty_pcm_spool import SpottyPcmSpool
+from spotty_range_stream import SpottyRangeStream
 from utils import log_msg, LOGDEBUG
 
 
 class HTTPSpottyAudioStreamer:
-    def __init__(self, spotty: Spotty, gap_between_tracks: int = 0, use_normalization: bool = True):
+    def __init__(
+        self,
+        spotty: Spotty,
+        pcm_spool: SpottyPcmSpool,
+        max_decoders: int,
+        gap_between_tracks: int = 0,
+        use_normalization: bool = True,
+    ):
         self.__spotty: Spotty = spotty
         self.__gap_between_tracks: int = gap_between_tracks
 
-        self.__spotty_streamer: SpottyAudioStreamer = SpottyAudioStreamer(self.__spotty)
+        self.__spotty_streamer: SpottyAudioStreamer = SpottyAudioStreamer(
+            self.__spotty, pcm_spool, max_decoders
+        )
         self.__spotty_streamer.use_normalization = use_normalization
 
-        self.__is_streaming = False
-        self.__stream_lock = threading.Lock()
-
     def use_normalization(self, value):
         self.__spotty_streamer.use_normalization = value
 
     def set_notify_track_finished(self, func: Callable[[str], None]) -> None:
         self.__spotty_streamer.set_notify_track_finished(func)
 
+    def set_max_decoders(self, max_decoders: int) -> None:
+        self.__spotty_streamer.set_max_decoders(max_decoders)
+
+    def set_stream_buffering(self, read_ahead_ms: int, prebuffer_ms: int) -> None:
+        self.__spotty_streamer.set_stream_buffering(read_ahead_ms, prebuffer_ms)
+
+    def set_stall_timeout(self, stall_timeout_in_secs: int) -> None:
+        self.__spotty_streamer.set_stall_timeout(stall_timeout_in_secs)
+
+    def prefetch_tracks(self, tracks: List[Tuple[str, float]], max_bytes_per_track: int) -> None:
+        self.__spotty_streamer.prefetch_tracks(tracks, max_bytes_per_track)
+
+    def terminate_prefetching(self) -> None:
+        self.__spotty_streamer.terminate_prefetching()
+        self.__spotty_streamer.warm_tracks([])
+
+    def set_warm_pool_size(self, max_size: int) -> None:
+        self.__spotty_streamer.set_warm_pool_size(max_size)
+
+    def warm_tracks(self, track_ids: List[str]) -> None:
+        self.__spotty_streamer.warm_tracks(track_ids)
+
     def stop(self) -> None:
         log_msg("Stopping spotty audio streaming.", LOGDEBUG)
-        if self.__is_streaming:
-            self.__terminate_streaming()
-        else:
-            log_msg("No running audio streamer. Nothing to stop.", LOGDEBUG)
+        self.__spotty_streamer.terminate_prefetching()
+        self.__spotty_streamer.stop_warm_pool()
+        self.__terminate_streaming()
 
     def __terminate_streaming(self) -> None:
-        if self.__spotty_streamer.terminate_stream():
-            log_msg(f"Terminated running streamer.", LOGDEBUG)
+        if self.__spotty_streamer.terminate_all_streams():
+            log_msg(f"Terminated running streams.", LOGDEBUG)
         else:
-            log_msg(f"No running streamer. Nothing to terminate.", LOGDEBUG)
+            log_msg(f"No running streams. Nothing to terminate.", LOGDEBUG)
 
     SPOTTY_AUDIO_TRACK_ROUTE = "/track/<track_id>/<duration>"
     # e.g., track_id = "2eHtBGvfD7PD7SiTl52Vxr", duration = 178.795
@@ -44,69 +71,93 @@ class HTTPSpottyAudioStreamer:
     # IMPORTANT: If Kodi is running in non-buffered file mode (e.g., cache/buffermode=3 in
     #   'advancedsettings.xml'), then 'CurlFile::Open' will do multiple HTTP GETs for a stream
     #   and eventually request a partial range. That's why there's the added complication
-    #   of the '__is_streaming' flag and 'request ranges' code below. (Not to mention
-    #   requiring a multithreaded web server to handle the streaming.)
-    def spotty_stream_audio_track(self, track_id: str, duration: str) -> bottle.Response:
+    #   of the shared track buffer and 'request ranges' code below. Repeated and overlapping
+    #   requests for the same track are all served from the one spotty process feeding the
+    #   buffer. (Not to mention requiring a multithreaded web server to handle the streaming.)
+    #   Each request gets its own stream session, so other clients streaming other tracks
+    #   at the same time are left alone.
+    def spotty_stream_audio_track(
+        self, track_id: str, duration: str
+    ) -> Union[bottle.Response, SpottyRangeStream]:
         log_msg(f"GET request: {bottle.request}", LOGDEBUG)
 
-        if self.__is_streaming:
-            with self.__stream_lock:
-                log_msg("Already streaming. Terminating current streamer.")
-                self.__terminate_streaming()
-
-        self.__is_streaming = True
+        if self.__gap_between_tracks and not self.__spotty_streamer.is_streaming_track(track_id):
+            # Sometimes, when playing a playlist with no gap between tracks, Kodi does not
+            # shutdown the visualizer before starting the next track and visualizer. So one
+            # visualizer instance is stopping at the same time as another is starting.
+            # Give some time for visualizations to finish, counted from when the previous
+            # track's streams have closed.
+            self.__spotty_streamer.wait_for_track_handoff(track_id, self.__gap_between_tracks)
 
-        if self.__gap_between_tracks:
-            # TODO - Can we improve on this? Sometimes, when playing a playlist
-            #        with no gap between tracks, Kodi does not shutdown the visualizer
-            #        before starting the next track and visualizer. So one visualizer
-            #        instance is stopping at the same time as another is starting.
-            # Give some time for visualizations to finish.
-            time.sleep(self.__gap_between_tracks)
-
-        self.__spotty_streamer.set_track(track_id, float(duration))
-
-        log_msg(
-            f"Start streaming spotify track '{track_id}',"
-            f" track length {self.__spotty_streamer.get_track_length()}."
-        )
-
-        file_size = self.__spotty_streamer.get_track_length()
+        # Known from the duration, so HEAD requests and unsatisfiable ranges need no decoder.
+        file_size = self.__spotty_streamer.get_track_length(float(duration))
         range_begin = 0
         range_end = file_size
-
-        def generate() -> str:
-            range_len = range_end - range_begin
-            return self.__spotty_streamer.send_part_audio_stream(range_len, range_begin)
+        log_msg(f"Start streaming spotify track '{track_id}', track length {file_size}.")
 
         request_range = bottle.request.headers.get("Range", "")
         log_msg(f"Request header range: '{request_range}'.", LOGDEBUG)
 
-        if not request_range or request_range == "bytes=0-":
+        stream_range = self.__parse_range(request_range, file_size)
+        if not stream_range:
             status = 200
             content_range = ""
             log_msg(f"Full request, content length = {range_end- range_begin}.", LOGDEBUG)
         else:
             status = "206 Partial Content"
-            stream_range = bottle.request.headers["Range"].split("bytes=")[1].split("-")
-            range_begin = int(stream_range[0])
-            range_end = int(stream_range[1]) if stream_range[1].isdigit() else file_size
-            content_range = f"bytes {range_begin}-{range_end}/{file_size}"
+            range_begin, range_end = stream_range
+            if range_begin >= range_end:
+                return bottle.HTTPError(
+                    416,
+                    "Requested range not satisfiable.",
+                    headers={"Content-Range": f"bytes */{file_size}"},
+                )
+            content_range = f"bytes {range_begin}-{range_end - 1}/{file_size}"
             log_msg(
                 f"Partial request, range = {content_range}," f" length = {range_end - range_begin}",
                 LOGDEBUG,
             )
 
+        if bottle.request.method.upper() == "GET":
+            session = self.__spotty_streamer.open_session(track_id, float(duration))
+            if not session:
+                return bottle.HTTPError(503, "Too many concurrent streams.")
+            try:
+                # Bottle hands file-like results to the server's 'wsgi.file_wrapper', which
+                # is what lets 'bottle_manager' send them with 'os.sendfile'.
+                body = self.__spotty_streamer.open_range_stream(
+                    session, range_end - range_begin, range_begin
+                )
+            except Exception:
+                self.__spotty_streamer.close_session(session)
+                raise
+        else:
+            body = bottle.Response()
+
         bottle.response.status = status
         bottle.response.headers["Accept-Ranges"] = "bytes"
         bottle.response.content_type = "audio/x-wav"
         bottle.response.content_length = range_end - range_begin
         if content_range:
             bottle.response.headers["Content-Range"] = content_range
-
-        if bottle.request.method.upper() == "GET":
-            return bottle.Response(generate())
-
-        return bottle.Response()
+        return body
+
+    @staticmethod
+    def __parse_range(request_range: str, file_size: int) -> Union[Tuple[int, int], None]:
+        """The requested byte range as (begin, end), with 'end' one past its last byte, or
+        None to send the whole track. A malformed or multiple range is ignored."""
+        if not request_range.startswith("bytes="):
+            return None
+        first, sep, last = request_range[len("bytes=") :].strip().partition("-")
+        if not sep or not (first or last) or not all(n.isdigit() for n in (first, last) if n):
+            log_msg(f"Ignoring unsupported range '{request_range}'.", LOGDEBUG)
+            return None
+        if not first:
+            # A suffix range, for the last bytes of the track.
+            return max(0, file_size - int(last)), file_size
+        if first == "0" and not last:
+            return None
+        # The range's end is the index of its last byte, so one less than 'range_end'.
+        return int(first), min(int(last) + 1, file_size) if last else file_size
 
     spotty_stream_audio_track.route = SPOTTY_AUDIO_TRACK_ROUTE
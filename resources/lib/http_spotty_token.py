@@ -0,0 +1,32 @@
+from typing import Dict, Union
+
+import bottle
+from http_service_auth import HTTPServiceAuth
+from spotty_token_broker import SpottyTokenBroker
+from utils import log_msg, LOGDEBUG, TOKEN_WAIT_TIMEOUT_IN_SECS
+
+
+class HTTPSpottyToken:
+    """Hands the service's Spotify token to plugin invocations. Right after Kodi starts, a
+    request waits for the first token instead of the plugin polling for it."""
+
+    def __init__(self, token_broker: SpottyTokenBroker, service_auth: HTTPServiceAuth):
+        self.__token_broker = token_broker
+        self.__service_auth = service_auth
+
+    SPOTTY_TOKEN_ROUTE = "/token"
+
+    def spotty_token(self) -> Union[Dict[str, str], bottle.HTTPError]:
+        auth_error = self.__service_auth.check_request()
+        if auth_error:
+            return auth_error
+
+        token = self.__token_broker.wait_for_token(TOKEN_WAIT_TIMEOUT_IN_SECS)
+        if not token:
+            log_msg(f"No Spotify token after {TOKEN_WAIT_TIMEOUT_IN_SECS}s.", LOGDEBUG)
+            return bottle.HTTPError(503, "No Spotify token yet.")
+
+        bottle.response.headers["Cache-Control"] = "no-store"
+        return {"access_token": token["access_token"], "expires_at": token["expires_at"]}
+
+    spotty_token.route = SPOTTY_TOKEN_ROUTE
@@ -0,0 +1,201 @@
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Tuple
+
+from xbmc import LOGDEBUG
+
+from utils import log_msg, log_exception
+
+# Workers with nothing to do for this long exit. The pool starts new ones when needed.
+IDLE_WORKER_TIMEOUT_IN_SECS = 30
+DISPATCH_CHECK_INTERVAL_IN_SECS = 1.0
+# Enough of a request to get the path from its first line.
+REQUEST_PEEK_LEN = 2048
+
+
+def get_request_path(request_start: bytes) -> str:
+    """The path of the request line at the start of 'request_start', or "" if there is none
+    yet."""
+    request_line = request_start.split(b"\r\n", 1)[0].split()
+    if len(request_line) < 2:
+        return ""
+    return request_line[1].decode("iso-8859-1")
+
+
+class HttpWorkerPool:
+    """A fixed number of worker threads serving connections from a bounded backlog.
+    Connections waiting between requests are closed to free a worker when one is needed."""
+
+    def __init__(self, name: str, max_workers: int, max_backlog: int):
+        self.__name = name
+        self.__max_workers = max_workers
+        self.__max_backlog = max_backlog
+        self.__work_added = threading.Condition()
+        self.__backlog = deque()
+        self.__worker_count = 0
+        self.__idle_worker_count = 0
+        # Connections waiting for their next request, oldest first. Socket -> idle since.
+        self.__idle_connections: Dict[socket.socket, float] = OrderedDict()
+        self.__stopped = False
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    def submit(self, job: Callable[[], None]) -> bool:
+        """Returns False if the backlog is full."""
+        with self.__work_added:
+            if self.__stopped or len(self.__backlog) >= self.__max_backlog:
+                return False
+            self.__backlog.append(job)
+            if self.__idle_worker_count < len(self.__backlog):
+                if self.__worker_count < self.__max_workers:
+                    self.__worker_count += 1
+                    threading.Thread(target=self.__work, daemon=True).start()
+                else:
+                    self.__close_oldest_idle_connection()
+            self.__work_added.notify()
+            return True
+
+    def set_connection_idle(self, connection: socket.socket) -> None:
+        with self.__work_added:
+            self.__idle_connections[connection] = time.monotonic()
+            # Work may be waiting for this very worker.
+            if self.__backlog and self.__idle_worker_count < len(self.__backlog):
+                self.__close_oldest_idle_connection()
+
+    def set_connection_busy(self, connection: socket.socket) -> bool:
+        """Returns False if the connection was closed while idle, so it can't be used."""
+        with self.__work_added:
+            return self.__idle_connections.pop(connection, None) is not None
+
+    def stop(self) -> None:
+        with self.__work_added:
+            self.__stopped = True
+            self.__backlog.clear()
+            # Workers waiting for a next request on these would otherwise wait out the idle
+            # timeout.
+            while self.__idle_connections:
+                self.__close_oldest_idle_connection()
+            self.__work_added.notify_all()
+
+    def __work(self) -> None:
+        while True:
+            with self.__work_added:
+                self.__idle_worker_count += 1
+                self.__work_added.wait_for(
+                    lambda: self.__backlog or self.__stopped, IDLE_WORKER_TIMEOUT_IN_SECS
+                )
+                self.__idle_worker_count -= 1
+                if not self.__backlog:
+                    self.__worker_count -= 1
+                    return
+                job = self.__backlog.popleft()
+            try:
+                job()
+            except Exception as exc:
+                log_exception(exc, f"Error in '{self.__name}' HTTP worker")
+
+    def __close_oldest_idle_connection(self) -> None:
+        if not self.__idle_connections:
+            return
+        connection, _ = self.__idle_connections.popitem(last=False)
+        log_msg(f"Closing an idle connection to free a '{self.__name}' worker.", LOGDEBUG)
+        try:
+            # Ends the worker's wait for the next request on it.
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ConnectionDispatcher:
+    """Waits on new connections without tying up a worker, and hands each one over once
+    its first request has arrived, along with that request's path."""
+
+    def __init__(
+        self,
+        dispatch: Callable[[socket.socket, Tuple, str], None],
+        on_timeout: Callable[[socket.socket], None],
+        timeout_in_secs: float,
+    ):
+        self.__dispatch = dispatch
+        self.__on_timeout = on_timeout
+        self.__timeout_in_secs = timeout_in_secs
+        self.__lock = threading.Lock()
+        # New connections for the dispatcher thread: (socket, client address, added time).
+        self.__new_connections = []
+        self.__wake_reader, self.__wake_writer = socket.socketpair()
+        self.__wake_reader.setblocking(False)
+        self.__thread: threading.Thread = None
+        self.__stopped = False
+
+    def add(self, connection: socket.socket, client_address: Tuple) -> None:
+        with self.__lock:
+            self.__new_connections.append((connection, client_address, time.monotonic()))
+            if not self.__thread:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+        self.__wake_writer.send(b"\0")
+
+    def stop(self) -> None:
+        """Closes the connections still waiting for their first request."""
+        with self.__lock:
+            self.__stopped = True
+            if not self.__thread:
+                return
+        self.__wake_writer.send(b"\0")
+        self.__thread.join()
+
+    def __run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.__wake_reader, selectors.EVENT_READ)
+        while not self.__stopped:
+            try:
+                for key, _ in selector.select(DISPATCH_CHECK_INTERVAL_IN_SECS):
+                    if key.fileobj is self.__wake_reader:
+                        self.__register_new_connections(selector)
+                    else:
+                        selector.unregister(key.fileobj)
+                        client_address, _ = key.data
+                        self.__dispatch(key.fileobj, client_address, self.__peek_path(key.fileobj))
+                self.__time_out_connections(selector)
+            except Exception as exc:
+                log_exception(exc, "Error dispatching HTTP connections")
+
+        for key in list(selector.get_map().values()):
+            if key.fileobj is not self.__wake_reader:
+                key.fileobj.close()
+        selector.close()
+
+    def __register_new_connections(self, selector: selectors.BaseSelector) -> None:
+        try:
+            while self.__wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.__lock:
+            new_connections, self.__new_connections = self.__new_connections, []
+        for connection, client_address, added_time in new_connections:
+            selector.register(connection, selectors.EVENT_READ, (client_address, added_time))
+
+    def __time_out_connections(self, selector: selectors.BaseSelector) -> None:
+        now = time.monotonic()
+        for key in list(selector.get_map().values()):
+            if key.fileobj is self.__wake_reader:
+                continue
+            _, added_time = key.data
+            if now - added_time >= self.__timeout_in_secs:
+                selector.unregister(key.fileobj)
+                self.__on_timeout(key.fileobj)
+
+    @staticmethod
+    def __peek_path(connection: socket.socket) -> str:
+        """The path of the request line, or "" if there is none yet."""
+        try:
+            return get_request_path(connection.recv(REQUEST_PEEK_LEN, socket.MSG_PEEK))
+        except OSError:
+            return ""
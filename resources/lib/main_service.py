@@ -6,30 +6,81 @@
 """
 
 import time
-from typing import Dict
+from typing import Dict, List
 
 import xbmc
 import xbmcaddon
 import xbmcgui
-from xbmc import LOGDEBUG, LOGWARNING
 
 import bottle_manager
 import utils
+from http_service_auth import HTTPServiceAuth
 from http_spotty_audio_streamer import HTTPSpottyAudioStreamer
+from http_spotify_web_api import HTTPSpotifyWebApi
+from http_spotty_token import HTTPSpottyToken
 from http_video_player_setter import HttpVideoPlayerSetter
+from playlist_prefetcher import PlaylistPrefetcher
 from save_recently_played import SaveRecentlyPlayed
+from spotify_web_api_gateway import SpotifyWebApiGateway, SpotifyWebApiGatewayClient
 from spotty import Spotty
 from spotty_auth import SpottyAuth
+from spotty_pcm_spool import SpottyPcmSpool, get_scratch_dir
+from spotty_token_broker import SpottyTokenBroker
 from spotty_helper import SpottyHelper
 from connect_helper import ConnectHelper
 from string_ids import HTTP_VIDEO_RULE_ADDED_STR_ID
-from utils import PROXY_PORT, log_msg, ADDON_ID
+from utils import PROXY_PORT, log_msg, log_exception, ADDON_ID, ADDON_DATA_PATH
 
 SAVE_TO_RECENTLY_PLAYED_FILE = True
 
 SPOTIFY_ADDON = xbmcaddon.Addon(id=ADDON_ID)
 
 
+def get_pcm_spool_max_bytes() -> int:
+    return int(SPOTIFY_ADDON.getSetting("pcm_spool_size_mb") or 0) * 1024 * 1024
+
+
+def get_pcm_scratch_max_bytes() -> int:
+    return int(SPOTIFY_ADDON.getSetting("pcm_scratch_size_mb") or 0) * 1024 * 1024
+
+
+def get_prefetch_track_count() -> int:
+    return int(SPOTIFY_ADDON.getSetting("prefetch_track_count") or 0)
+
+
+def get_prefetch_max_bytes() -> int:
+    return int(SPOTIFY_ADDON.getSetting("prefetch_size_mb") or 0) * 1024 * 1024
+
+
+def get_warm_pool_size() -> int:
+    return int(SPOTIFY_ADDON.getSetting("spotty_warm_pool_size") or 0)
+
+
+def get_max_decoders() -> int:
+    return max(1, int(SPOTIFY_ADDON.getSetting("max_concurrent_decoders") or 1))
+
+
+def get_stream_read_ahead_ms() -> int:
+    return int(SPOTIFY_ADDON.getSetting("stream_read_ahead_ms") or 0)
+
+
+def get_stream_prebuffer_ms() -> int:
+    return int(SPOTIFY_ADDON.getSetting("stream_prebuffer_ms") or 0)
+
+
+def get_stream_stall_timeout_secs() -> int:
+    return int(SPOTIFY_ADDON.getSetting("stream_stall_timeout_secs") or 0)
+
+
+def use_asyncio_http_server() -> bool:
+    return SPOTIFY_ADDON.getSetting("use_asyncio_http_server").lower() == "true"
+
+
+def get_spotty_cpus() -> List[int]:
+    cpus = SPOTIFY_ADDON.getSetting("spotty_cpus").replace(" ", "")
+    return [int(cpu) for cpu in cpus.split(",") if cpu.isdigit()]
+
+
 def abort_app(timeout_in_secs: int) -> bool:
     return xbmc.Monitor().waitForAbort(timeout_in_secs)
 
@@ -57,9 +108,12 @@ class MainService:
             self.__spotty_helper.spotty_binary_path, self.__spotty_helper.spotty_cache_path
         )
         self.__spotty.set_spotty_env(self.__spotty_helper.spotty_rust_env)
+        self.__spotty.set_cpus(get_spotty_cpus())
 
         self.__spotty_auth: SpottyAuth = SpottyAuth(self.__spotty)
-        self.__auth_token: Dict[str, str] = dict()
+        self.__token_broker = SpottyTokenBroker(self.__get_token, self.__publish_token)
+        self.__web_api_gateway = SpotifyWebApiGateway(self.__token_broker)
+        self.__connect_daemon: ConnectHelper = None
 
         # Workaround to make Kodi use it's VideoPlayer to play http audio streams.
         # If we don't do this, then Kodi uses PAPlayer which does not stream.
@@ -67,13 +121,29 @@ class MainService:
 
         gap_between_tracks = int(SPOTIFY_ADDON.getSetting("gap_between_playlist_tracks"))
         use_spotify_normalization = SPOTIFY_ADDON.getSetting("use_spotify_normalization").lower() == "true"
+        self.__pcm_spool: SpottyPcmSpool = SpottyPcmSpool(
+            f"{ADDON_DATA_PATH}/pcm-spool",
+            get_pcm_spool_max_bytes(),
+            get_scratch_dir(f"{ADDON_ID}-pcm-scratch"),
+            get_pcm_scratch_max_bytes(),
+        )
         self.__http_spotty_streamer: HTTPSpottyAudioStreamer = HTTPSpottyAudioStreamer(
-            self.__spotty, gap_between_tracks, use_spotify_normalization
+            self.__spotty,
+            self.__pcm_spool,
+            get_max_decoders(),
+            gap_between_tracks,
+            use_spotify_normalization,
+        )
+        self.__save_recently_played: SaveRecentlyPlayed = SaveRecentlyPlayed(
+            SpotifyWebApiGatewayClient(self.__web_api_gateway)
         )
-        self.__save_recently_played: SaveRecentlyPlayed = SaveRecentlyPlayed()
         self.__http_spotty_streamer.set_notify_track_finished(self.__save_track_to_recently_played)
+        self.__playlist_prefetcher = PlaylistPrefetcher(self.__http_spotty_streamer)
 
-        bottle_manager.route_all(self.__http_spotty_streamer)
+        bottle_manager.route_all(self.__http_spotty_streamer, bottle_manager.AUDIO_LANE)
+        self.__service_auth = HTTPServiceAuth()
+        bottle_manager.route_all(HTTPSpottyToken(self.__token_broker, self.__service_auth))
+        bottle_manager.route_all(HTTPSpotifyWebApi(self.__web_api_gateway, self.__service_auth))
 
     def __save_track_to_recently_played(self, track_id: str) -> None:
         if SAVE_TO_RECENTLY_PLAYED_FILE:
@@ -82,10 +152,10 @@ class MainService:
     def run(self) -> None:
         log_msg("Starting main service loop.")
 
-        bottle_manager.start_thread(PROXY_PORT)
+        bottle_manager.start_thread(PROXY_PORT, use_asyncio_http_server())
         log_msg(f"Started bottle with port {PROXY_PORT}.")
 
-        self.__renew_token()
+        self.__token_broker.start()
 
         loop_counter = 0
         loop_wait_in_secs = 6
@@ -93,22 +163,23 @@ class MainService:
             loop_counter += 1
             if (loop_counter % 10) == 0:
                 log_msg(f"Main loop continuing. Loop counter: {loop_counter}.")
+                log_msg(f"HTTP stats: {bottle_manager.get_connection_stats().get_summary()}.")
+                log_msg(f"Web API cache stats: {self.__web_api_gateway.get_cache_stats()}.")
 
             self.__http_spotty_streamer.use_normalization(
                 SPOTIFY_ADDON.getSetting("use_spotify_normalization").lower() == "true"
             )
-
-            # Monitor authorization.
-            if (int(self.__auth_token["expires_at"]) - 60) <= (int(time.time())):
-                expire_time = int(self.__auth_token["expires_at"])
-                time_now = int(time.time())
-                log_msg(
-                    f"Spotify token expired."
-                    f" Expire time: {self.__get_time_str(expire_time)} ({expire_time});"
-                    f" time now: {self.__get_time_str(time_now)} ({time_now})."
-                )
-                log_msg("Refreshing auth token now.")
-                self.__renew_token()
+            self.__pcm_spool.set_max_bytes(get_pcm_spool_max_bytes())
+            self.__pcm_spool.set_max_scratch_bytes(get_pcm_scratch_max_bytes())
+            self.__spotty.set_cpus(get_spotty_cpus())
+            self.__http_spotty_streamer.set_max_decoders(get_max_decoders())
+            self.__http_spotty_streamer.set_stream_buffering(
+                get_stream_read_ahead_ms(), get_stream_prebuffer_ms()
+            )
+            self.__http_spotty_streamer.set_stall_timeout(get_stream_stall_timeout_secs())
+            self.__playlist_prefetcher.set_limits(
+                get_prefetch_track_count(), get_prefetch_max_bytes(), get_warm_pool_size()
+            )
 
             if abort_app(loop_wait_in_secs):
                 break
@@ -118,49 +189,33 @@ class MainService:
     def __close(self) -> None:
         log_msg("Shutdown requested.")
         self.__http_spotty_streamer.stop()
-        self.__spotty_helper.kill_all_spotties()
+        self.__pcm_spool.close()
+        # Stopping the spotties first also ends any token renewal in progress.
+        self.__spotty.stop_all_spotties()
+        self.__token_broker.stop()
         bottle_manager.stop_thread()
+        self.__service_auth.close()
         log_msg("Main service stopped.")
 
-    def __renew_token(self) -> None:
-        log_msg("Retrieving auth token....", LOGDEBUG)
-
-        self.__auth_token = self.__get_retry_auth_token()
-        if not self.__auth_token:
-            utils.cache_auth_token("")
-            raise Exception(
-                f"Could not get Spotify auth token for"
-                f" user '{self.__spotty_helper.get_username()}'."
-            )
-
+    def __publish_token(self, auth_token: Dict[str, str]) -> None:
         log_msg(
             f"Retrieved Spotify auth token."
-            f" Expires at {self.__get_time_str(int(self.__auth_token['expires_at']))}."
+            f" Expires at {self.__get_time_str(int(auth_token['expires_at']))}."
         )
 
         # Cache auth token for easy access by the plugin.
-        utils.cache_auth_token(self.__auth_token["access_token"])
-
-        # try starting spotty connect daemon
-        self.connect_daemon = ConnectHelper(self.__spotty)
-        if not self.connect_daemon.daemon_active:
-            self.connect_daemon.start()
-
-    def __get_retry_auth_token(self) -> Dict[str, str]:
-        auth_token = None
-        max_retries = 20
-        count = 0
-        while count < max_retries:
-            auth_token = self.__get_token()
-            if auth_token:
-                break
-            time.sleep(1)
-            count += 1
-
-        if count > 0:
-            log_msg(f"Took {count} retries to get authorization token.", LOGWARNING)
-
-        return auth_token
+        utils.cache_auth_token(auth_token["access_token"])
+        # The user's profile goes with the token, so fetch it now rather than in the first
+        # plugin invocation that needs it.
+        try:
+            self.__web_api_gateway.cache_user_profile()
+        except Exception as exc:
+            log_exception(exc, "Could not get the Spotify user profile")
+
+        # Start the spotty connect daemon once. It doesn't need restarting for a new token.
+        if not self.__connect_daemon:
+            self.__connect_daemon = ConnectHelper(self.__spotty)
+            self.__connect_daemon.start()
 
     def __get_token(self) -> Dict[str, str]:
         self.__spotty.set_spotify_user(
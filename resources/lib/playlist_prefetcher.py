@@ -0,0 +1,70 @@
+import re
+from typing import List, Tuple
+
+import xbmc
+from xbmc import LOGDEBUG
+
+from http_spotty_audio_streamer import HTTPSpottyAudioStreamer
+from utils import PROXY_PORT, log_msg, log_exception
+
+# Matches the urls made by 'PluginContent' for 'HTTPSpottyAudioStreamer.SPOTTY_AUDIO_TRACK_ROUTE'.
+TRACK_URL_REGEX = re.compile(rf"^http://localhost:{PROXY_PORT}/track/([^/]+)/([0-9.]+)$")
+
+
+class PlaylistPrefetcher(xbmc.Player):
+    """Watches Kodi's music playlist and starts decoding the next queued tracks early."""
+
+    def __init__(self, http_spotty_streamer: HTTPSpottyAudioStreamer):
+        super().__init__()
+        self.__http_spotty_streamer = http_spotty_streamer
+        self.__track_count = 0
+        self.__max_bytes = 0
+        self.__warm_pool_size = 0
+
+    def set_limits(self, track_count: int, max_bytes: int, warm_pool_size: int) -> None:
+        self.__track_count = track_count
+        self.__max_bytes = max_bytes
+        self.__warm_pool_size = warm_pool_size
+        self.__http_spotty_streamer.set_warm_pool_size(warm_pool_size)
+
+    def onAVStarted(self) -> None:
+        try:
+            self.__prefetch_upcoming_tracks()
+        except Exception as exc:
+            log_exception(exc, "Could not prefetch upcoming tracks")
+
+    def onPlayBackStopped(self) -> None:
+        self.__http_spotty_streamer.terminate_prefetching()
+
+    def __prefetch_upcoming_tracks(self) -> None:
+        prefetch_count = self.__track_count if self.__max_bytes > 0 else 0
+        if prefetch_count <= 0 and self.__warm_pool_size <= 0:
+            return
+
+        upcoming_tracks = self.__get_upcoming_tracks(prefetch_count + self.__warm_pool_size)
+        log_msg(f"Upcoming tracks to prefetch: {upcoming_tracks}.", LOGDEBUG)
+
+        # The nearest tracks get decoded into buffers. Warm spotties wait for the ones after.
+        if prefetch_count > 0:
+            self.__http_spotty_streamer.prefetch_tracks(
+                upcoming_tracks[:prefetch_count], self.__max_bytes // prefetch_count
+            )
+        self.__http_spotty_streamer.warm_tracks(
+            [track_id for track_id, _ in upcoming_tracks[prefetch_count:]]
+        )
+
+    @staticmethod
+    def __get_upcoming_tracks(track_count: int) -> List[Tuple[str, float]]:
+        playlist = xbmc.PlayList(xbmc.PLAYLIST_MUSIC)
+        position = playlist.getposition()
+        if position < 0:
+            return []
+
+        upcoming_tracks = []
+        last_position = min(position + track_count, playlist.size() - 1)
+        for index in range(position + 1, last_position + 1):
+            match = TRACK_URL_REGEX.match(playlist[index].getPath())
+            if match:
+                upcoming_tracks.append((match.group(1), float(match.group(2))))
+
+        return upcoming_tracks
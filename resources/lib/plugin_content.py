@@ -3,20 +3,22 @@ import os
 import sys
 import time
 import urllib.parse
-from typing import Any, Dict, List, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Union
 
-import simplecache
 import xbmc
 import xbmcaddon
 import xbmcgui
 import xbmcplugin
 import xbmcvfs
 
-import spotipy
 import utils
+from spotify_web_api_client import SpotifyWebApiClient
 from string_ids import *
 from utils import ADDON_ID, PROXY_PORT, log_exception, log_msg, get_chunks
 
+if TYPE_CHECKING:
+    import simplecache
+
 MUSIC_ARTISTS_ICON = "icon_music_artists.png"
 MUSIC_TOP_ARTISTS_ICON = "icon_music_top_artists.png"
 MUSIC_SONGS_ICON = "icon_music_songs.png"
@@ -30,34 +32,68 @@ CLEAR_CACHE_ICON = "icon_clear_cache.png"
 
 Playlist = Dict[str, Union[str, Dict[str, List[Any]]]]
 
+# A cold import of the plugin, with no modules left loaded by an earlier invocation, should
+# take less than this. Only checked at run time, by 'log_import_time': the add-on has no test
+# suite, and the import needs Kodi's own modules.
+PLUGIN_IMPORT_BUDGET_IN_MS = 250
+# Slow to import, so only loaded by the invocations that need them.
+LAZILY_IMPORTED_MODULES = ["simplecache", "spotipy", "requests"]
+
+# Actions that need neither Spotify nor the cache, so they don't wait for a token or load
+# 'spotipy' and 'simplecache'.
+LOCAL_ACTIONS = {"delete_cache_db", "refresh_listing"}
+
+
+def log_import_time(import_time_in_secs: float, is_cold_start: bool) -> None:
+    """Log how long importing the plugin took, and which slow modules got loaded with it."""
+    import_time_in_ms = int(1000 * import_time_in_secs)
+    start = "Cold" if is_cold_start else "Warm"
+    loaded = [module for module in LAZILY_IMPORTED_MODULES if module in sys.modules]
+    msg = f"{start} plugin import took {import_time_in_ms}ms. Lazy modules loaded: {loaded}."
+    if is_cold_start and import_time_in_ms > PLUGIN_IMPORT_BUDGET_IN_MS:
+        log_msg(f"{msg} That's over the {PLUGIN_IMPORT_BUDGET_IN_MS}ms budget.", xbmc.LOGWARNING)
+    else:
+        log_msg(msg, xbmc.LOGDEBUG)
+
 
 class PluginContent:
-    __addon: xbmcaddon.Addon = xbmcaddon.Addon(id=ADDON_ID)
+    # Kodi may run each invocation in the same interpreter ('reuselanguageinvoker'), so only
+    # what's safe to share between invocations is kept in the class.
     __win: xbmcgui.Window = xbmcgui.Window(utils.ADDON_WINDOW_ID)
-    __addon_icon_path = os.path.join(__addon.getAddonInfo("path"), "resources")
-    __action = ""
-    __spotipy = None
-    __userid = ""
-    __user_country = ""
-    __offset = 0
-    __playlist_id = ""
-    __album_id = ""
-    __track_id = ""
-    __artist_id = ""
-    __artist_name = ""
-    __owner_id = ""
-    __filter = ""
-    __token = ""
-    __limit = 50
-    __params = {}
-    __base_url = sys.argv[0]
-    __addon_handle = int(sys.argv[1])
-    __cached_checksum = ""
-    __last_playlist_position = 0
 
     def __init__(self):
+        # Read per invocation, so settings changed since the last one are used.
+        self.__addon: xbmcaddon.Addon = xbmcaddon.Addon(id=ADDON_ID)
+        self.__addon_icon_path = os.path.join(self.__addon.getAddonInfo("path"), "resources")
+        self.__base_url = sys.argv[0]
+        self.__addon_handle = int(sys.argv[1])
+        self.__params: Dict[str, Any] = {}
+        self.__action = ""
+        self.__spotipy = None
+        self.__userid = ""
+        self.__user_country = ""
+        self.__offset = 0
+        self.__playlist_id = ""
+        self.__album_id = ""
+        self.__track_id = ""
+        self.__artist_id = ""
+        self.__artist_name = ""
+        self.__owner_id = ""
+        self.__filter = ""
+        self.__token = ""
+        self.__is_service_running = False
+        self.__limit = 50
+        self.__cached_checksum = ""
+        self.__last_playlist_position = 0
+
         try:
-            self.cache: simplecache.SimpleCache = simplecache.SimpleCache(ADDON_ID)
+            self.parse_params()
+            if self.__action in LOCAL_ACTIONS:
+                log_msg(f"Evaluating local action '{self.__action}'.")
+                getattr(self, self.__action)()
+                return
+
+            self.cache: simplecache.SimpleCache = self.__create_cache()
 
             self.append_artist_to_title: bool = (
                 self.__addon.getSetting("appendArtistToTitle") == "true"
@@ -73,11 +109,16 @@ class PluginContent:
                 xbmcplugin.endOfDirectory(handle=self.__addon_handle)
                 return
 
-            self.__spotipy: spotipy.Spotify = spotipy.Spotify(auth=auth_token)
-            self.__userid: str = self.__spotipy.me()["id"]
-            self.__user_country = self.__spotipy.me()["country"]
+            if self.__is_service_running:
+                self.__spotipy = SpotifyWebApiClient()
+            else:
+                # Only needed when the service can't make the calls, and slow to import.
+                import spotipy
 
-            self.parse_params()
+                self.__spotipy: spotipy.Spotify = spotipy.Spotify(auth=auth_token)
+            profile = utils.get_user_profile(self.__spotipy, auth_token)
+            self.__userid: str = profile["id"]
+            self.__user_country = profile["country"]
 
             if self.__action:
                 log_msg(f"Evaluating action '{self.__action}'.")
@@ -92,6 +133,13 @@ class PluginContent:
             log_exception(exc, "PluginContent init error")
             xbmcplugin.endOfDirectory(handle=self.__addon_handle)
 
+    @staticmethod
+    def __create_cache() -> "simplecache.SimpleCache":
+        # Per invocation. Its in-memory entries are window properties, shared anyway.
+        import simplecache
+
+        return simplecache.SimpleCache(ADDON_ID)
+
     def parse_params(self):
         """parse parameters from the plugin entry path"""
         log_msg(f"sys.argv = {str(sys.argv)}")
@@ -129,7 +177,11 @@ class PluginContent:
 
     def __get_authkey(self) -> str:
         """get authentication key"""
-        auth_token = utils.get_cached_auth_token()
+        auth_token = utils.get_service_auth_token()
+        # With the service up, Web API calls go through it, using its token.
+        self.__is_service_running = auth_token is not None
+        if auth_token is None:
+            auth_token = utils.get_cached_auth_token()
 
         if not auth_token:
             msg = self.__addon.getLocalizedString(NO_CREDENTIALS_MSG_STR_ID)
@@ -186,7 +238,11 @@ class PluginContent:
 
     def refresh_listing(self) -> None:
         self.__addon.setSetting("cache_checksum", time.strftime("%Y%m%d%H%M%S", time.gmtime()))
-        log_msg(f"New cache_checksum = \'{self.__addon.getSetting('cache_checksum')}\'")
+        try:
+            SpotifyWebApiClient().clear_cache()
+        except Exception as exc:
+            log_msg(f"Could not clear the service's Web API cache: {exc}")
+        log_msg(f"New cache_checksum = '{self.__addon.getSetting('cache_checksum')}'")
         xbmc.executebuiltin("Container.Refresh")
 
     def __add_track_listitems(self, tracks, append_artist_to_label: bool = False) -> None:
@@ -645,7 +701,9 @@ class PluginContent:
         if not self.__track_id and xbmc.getInfoLabel("MusicPlayer.(1).Property(spotifytrackid)"):
             self.__track_id = xbmc.getInfoLabel("MusicPlayer.(1).Property(spotifytrackid)")
 
-        own_playlists, own_playlist_names = utils.get_user_playlists(self.__spotipy, 50)
+        own_playlists, own_playlist_names = utils.get_user_playlists(
+            self.__spotipy, self.__userid, 50
+        )
         own_playlist_names.append(xbmc.getLocalizedString(KODI_NEW_PLAYLIST_STR_ID))
 
         xbmc.executebuiltin("Dialog.Close(busydialog)")
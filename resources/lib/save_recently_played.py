@@ -1,16 +1,17 @@
 import xbmc
 import xbmcaddon
 
-import spotipy
 import utils
+from spotify_web_api_gateway import SpotifyWebApiGatewayClient
 from utils import log_msg, ADDON_ID
 
 ADDON_SETTING_MY_RECENTLY_PLAYED_PLAYLIST_NAME = "my_recently_played_playlist_name"
 
 
 class SaveRecentlyPlayed:
-    def __init__(self):
-        self.__spotipy = None
+    def __init__(self, spotify: SpotifyWebApiGatewayClient):
+        # Through the service's gateway, so the plugin sees the saved tracks at once.
+        self.__spotipy = spotify
         self.__my_recently_played_playlist_id = None
 
     def save_track(self, track_id: str) -> None:
@@ -39,10 +40,11 @@ class SaveRecentlyPlayed:
     def __set_my_recently_played_playlist_id(self) -> None:
         my_recently_played_playlist_name = self.__get_my_recently_played_playlist_name()
 
-        self.__spotipy = spotipy.Spotify(auth=utils.get_cached_auth_token())
+        auth_token = utils.get_cached_auth_token()
+        userid = utils.get_user_profile(self.__spotipy, auth_token)["id"]
         log_msg(f"Getting id for '{my_recently_played_playlist_name}' playlist.", xbmc.LOGDEBUG)
         self.__my_recently_played_playlist_id = utils.get_user_playlist_id(
-            self.__spotipy, my_recently_played_playlist_name
+            self.__spotipy, userid, my_recently_played_playlist_name
         )
 
         if not self.__my_recently_played_playlist_id:
@@ -51,7 +53,6 @@ class SaveRecentlyPlayed:
                 " Creating one now.",
                 xbmc.LOGINFO,
             )
-            userid = self.__spotipy.me()["id"]
             playlist = self.__spotipy.user_playlist_create(
                 userid, my_recently_played_playlist_name, False
             )
@@ -0,0 +1,41 @@
+import json
+import urllib.error
+import urllib.request
+from typing import Any, Callable
+
+from utils import PROXY_PORT, get_service_request_headers
+
+WEB_API_CALL_TIMEOUT_IN_SECS = 30
+
+
+class SpotifyWebApiClient:
+    """Stands in for 'spotipy.Spotify' in plugin invocations, making each call through the
+    service's warm Web API client. A call is then a loopback round-trip, not a new TLS
+    connection to api.spotify.com."""
+
+    def __init__(self):
+        self.__url = f"http://localhost:{PROXY_PORT}/webapi"
+
+    def __getattr__(self, method: str) -> Callable[..., Any]:
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.__call(method, args, kwargs)
+
+    def __call(self, method: str, args, kwargs) -> Any:
+        request = urllib.request.Request(
+            self.__url,
+            data=json.dumps({"method": method, "args": args, "kwargs": kwargs}).encode(),
+            headers={"Content-Type": "application/json", **get_service_request_headers()},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=WEB_API_CALL_TIMEOUT_IN_SECS) as response:
+                return json.loads(response.read())["result"]
+        except urllib.error.HTTPError as exc:
+            # Imported here, as it's slow to import and only needed for errors.
+            import spotipy
+
+            try:
+                error = json.loads(exc.read())
+            except ValueError:
+                error = {"error": exc.reason}
+            raise spotipy.SpotifyException(exc.code, error.get("code", -1), error["error"])
@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple
+
+import requests
+import spotipy
+from requests.adapters import HTTPAdapter
+from xbmc import LOGDEBUG, LOGWARNING
+
+from spotty_token_broker import SpottyTokenBroker
+from utils import get_user_profile, log_msg, TOKEN_WAIT_TIMEOUT_IN_SECS
+
+# The Web API calls plugin invocations may make through the service.
+READ_METHODS = {
+    "album",
+    "album_tracks",
+    "albums",
+    "artist_albums",
+    "artist_related_artists",
+    "artist_top_tracks",
+    "artists",
+    "categories",
+    "category",
+    "category_playlists",
+    "current_user_followed_artists",
+    "current_user_playlists",
+    "current_user_saved_albums",
+    "current_user_saved_tracks",
+    "current_user_top_artists",
+    "current_user_top_tracks",
+    "featured_playlists",
+    "me",
+    "new_releases",
+    "next",
+    "playlist",
+    "search",
+    "tracks",
+    "user_playlist_tracks",
+    "user_playlists",
+}
+WRITE_METHODS = {
+    "current_user_follow_playlist",
+    "current_user_saved_albums_add",
+    "current_user_saved_albums_delete",
+    "current_user_saved_tracks_add",
+    "current_user_saved_tracks_delete",
+    "current_user_unfollow_playlist",
+    "playlist_add_items",
+    "playlist_remove_all_occurrences_of_items",
+    "user_follow_artists",
+    "user_playlist_create",
+    "user_unfollow_artists",
+}
+
+# Not a Web API call: empties the gateway's cache, e.g. for a manual refresh.
+CLEAR_CACHE_CALL = "clear_cache"
+# Calls with 'limit=1' to these only get a listing's total, to see whether it changed.
+TOTAL_PROBE_METHODS = {
+    "current_user_playlists",
+    "current_user_saved_albums",
+    "current_user_saved_tracks",
+    "user_playlists",
+}
+
+# Results of read calls are kept this long, so browsing back and forth doesn't go to Spotify.
+LIBRARY_CACHE_TTL_IN_SECS = 300
+MAX_LIBRARY_CACHE_ENTRIES = 256
+# Keep-alive connections kept open to api.spotify.com.
+MAX_POOLED_CONNECTIONS = 8
+
+
+class SpotifyWebApiGateway:
+    """The service's Spotify Web API client, kept warm for plugin invocations. Its pooled
+    keep-alive connections spare each invocation new TLS handshakes, and recent read results
+    are answered from memory. Writes through the gateway, a new token and a manual refresh
+    empty that cache. The calls the plugin makes to see whether a listing changed are never
+    cached, so edits made elsewhere, e.g. in the Spotify app, still show up."""
+
+    def __init__(self, token_broker: SpottyTokenBroker):
+        self.__token_broker = token_broker
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=MAX_POOLED_CONNECTIONS)
+        self.__session.mount("https://", adapter)
+
+        self.__lock = threading.Lock()
+        self.__spotipy: spotipy.Spotify = None
+        self.__access_token = ""
+        # (method, args, kwargs) -> (time cached, result), least recently used first.
+        self.__library_cache: Dict[str, Tuple[float, Any]] = OrderedDict()
+        self.__cache_hits = 0
+        self.__cache_misses = 0
+
+    def call(self, method: str, args: List[Any], kwargs: Dict[str, Any]) -> Any:
+        """Make the Web API call 'method'. Raises 'spotipy.SpotifyException' as spotipy does."""
+        if method == CLEAR_CACHE_CALL:
+            log_msg("Clearing Web API cache.", LOGDEBUG)
+            self.__clear_library_cache()
+            return None
+        if method not in READ_METHODS and method not in WRITE_METHODS:
+            raise spotipy.SpotifyException(400, -1, f"Unsupported Web API call '{method}'.")
+        if method in WRITE_METHODS:
+            result = self.__call_spotify(method, args, kwargs)
+            self.__clear_library_cache()
+            return result
+
+        if self.__is_change_probe(method, kwargs):
+            return self.__call_spotify(method, args, kwargs)
+
+        # Drops cached results first if the token has changed.
+        self.__get_spotipy()
+        key = repr((method, args, sorted(kwargs.items())))
+        result = self.__get_cached(key)
+        if result is not None:
+            return result
+        result = self.__call_spotify(method, args, kwargs)
+        self.__set_cached(key, result)
+        return result
+
+    def cache_user_profile(self) -> None:
+        """Fetch the user's profile for the current token, so plugin invocations find it
+        shared already."""
+        client = self.__get_spotipy()
+        get_user_profile(client, self.__access_token)
+
+    def get_cache_stats(self) -> str:
+        with self.__lock:
+            return (
+                f"{len(self.__library_cache)} cached result(s),"
+                f" {self.__cache_hits} hit(s), {self.__cache_misses} miss(es)"
+            )
+
+    def __get_spotipy(self) -> spotipy.Spotify:
+        token = self.__token_broker.get_token()
+        if not token:
+            raise spotipy.SpotifyException(503, -1, "The service has no Spotify token yet.")
+
+        with self.__lock:
+            if token["access_token"] != self.__access_token:
+                log_msg("Creating Web API client for new token.", LOGDEBUG)
+                self.__access_token = token["access_token"]
+                # Only the token changes. The session keeps its pooled connections.
+                self.__spotipy = spotipy.Spotify(
+                    auth=self.__access_token, requests_session=self.__session
+                )
+                # Results for another token may be for another user.
+                self.__library_cache.clear()
+            return self.__spotipy
+
+    def __call_spotify(self, method: str, args: List[Any], kwargs: Dict[str, Any]) -> Any:
+        """Make the call, renewing the token and trying once more if Spotify rejects it."""
+        try:
+            return getattr(self.__get_spotipy(), method)(*args, **kwargs)
+        except spotipy.SpotifyException as exc:
+            if exc.http_status != 401:
+                raise
+        log_msg(f"Spotify rejected the token for '{method}'. Renewing it.", LOGWARNING)
+        # Shares the renewal with any other call that was rejected meanwhile.
+        self.__token_broker.renew(TOKEN_WAIT_TIMEOUT_IN_SECS)
+        return getattr(self.__get_spotipy(), method)(*args, **kwargs)
+
+    @staticmethod
+    def __is_change_probe(method: str, kwargs: Dict[str, Any]) -> bool:
+        """Whether the plugin makes the call to see if a listing changed, using its total as
+        the checksum of its own cached listing."""
+        if method in TOTAL_PROBE_METHODS:
+            return kwargs.get("limit") == 1
+        if method == "playlist":
+            return "tracks(total)" in kwargs.get("fields", "")
+        if method == "current_user_followed_artists":
+            # The first page, with the total. Later pages come 'after' an artist.
+            return "after" not in kwargs
+        return False
+
+    def __get_cached(self, key: str) -> Any:
+        with self.__lock:
+            cached = self.__library_cache.get(key)
+            if not cached or time.monotonic() - cached[0] > LIBRARY_CACHE_TTL_IN_SECS:
+                self.__cache_misses += 1
+                return None
+            self.__library_cache.move_to_end(key)
+            self.__cache_hits += 1
+            return cached[1]
+
+    def __set_cached(self, key: str, result: Any) -> None:
+        with self.__lock:
+            self.__library_cache[key] = (time.monotonic(), result)
+            self.__library_cache.move_to_end(key)
+            while len(self.__library_cache) > MAX_LIBRARY_CACHE_ENTRIES:
+                self.__library_cache.popitem(last=False)
+
+    def __clear_library_cache(self) -> None:
+        with self.__lock:
+            self.__library_cache.clear()
+
+
+class SpotifyWebApiGatewayClient:
+    """Stands in for 'spotipy.Spotify' in the service itself, making each call through the
+    gateway, so its writes also empty the gateway's cache."""
+
+    def __init__(self, gateway: SpotifyWebApiGateway):
+        self.__gateway = gateway
+
+    def __getattr__(self, method: str) -> Callable[..., Any]:
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.__gateway.call(method, list(args), kwargs)
@@ -1,10 +1,14 @@
 import os
 import subprocess
-from typing import Dict, List
+import time
+from typing import Callable, Dict, List, Union
 
 import xbmc
 from xbmc import LOGDEBUG, LOGERROR
 
+from spotty_log_watcher import SpottyLogWatcher
+from spotty_process_manager import SpottyProcessManager
+from spotty_scheduling import SPOTTY_ROLE_STREAMING, apply_scheduling_policy
 from utils import log_msg
 
 # IMPORTANT: To allow 'spotty' to run on Android, we need to run it from the
@@ -22,6 +26,14 @@ SPOTTY_DEFAULT_ARGS = [
 ]
 
 
+class SpottyProcess(subprocess.Popen):
+    """A running spotty. If it has a log watcher, that reads its stderr."""
+
+    def __init__(self, args: List[str], log_watcher: Union[SpottyLogWatcher, None], **kwargs):
+        super().__init__(args, **kwargs)
+        self.log_watcher = log_watcher
+
+
 class Spotty:
     def __init__(self):
         self.__spotty_binary = ""
@@ -31,6 +43,9 @@ class Spotty:
         self.__spotty_rust_env = None
 
         self.__playback_supported = True
+        self.__process_manager = SpottyProcessManager()
+        # CPUs to run spotty on. Empty for any.
+        self.__cpus: List[int] = []
 
     def set_spotty_paths(self, spotty_binary: str, spotty_cache: str) -> None:
         self.__spotty_binary = spotty_binary
@@ -50,10 +65,28 @@ class Spotty:
         self.__spotify_username = username
         self.__spotify_password = password
 
+    def set_cpus(self, cpus: List[int]) -> None:
+        self.__cpus = cpus
+
+    def supervise_spotty(self, name: str, run: Callable[[], SpottyProcess]) -> None:
+        self.__process_manager.supervise(name, run)
+
+    def stop_all_spotties(self) -> None:
+        self.__process_manager.stop_all()
+
     def run_spotty(
-        self, extra_args: List[str] = None, use_creds: bool = False, ap_port: str = SPOTTY_PORT
-    ) -> subprocess.Popen:
+        self,
+        extra_args: List[str] = None,
+        use_creds: bool = False,
+        ap_port: str = SPOTTY_PORT,
+        log_name: str = "",
+        role: str = SPOTTY_ROLE_STREAMING,
+    ) -> SpottyProcess:
+        """Stdout and stderr are separate pipes. With a 'log_name', a log watcher thread
+        reads stderr. Otherwise the caller must read both, e.g. with 'communicate'.
+        The 'role' picks the process's CPU and I/O priorities."""
         log_msg("Running spotty...", LOGDEBUG)
+        spawn_start_time = time.monotonic()
 
         try:
             # os.environ["RUST_LOG"] = "debug"
@@ -81,12 +114,21 @@ class Spotty:
                 startupinfo = subprocess.STARTUPINFO()
                 startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
 
-            return subprocess.Popen(
-                args,
-                startupinfo=startupinfo,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                env=self.__spotty_rust_env,
+            log_watcher = SpottyLogWatcher(log_name, spawn_start_time) if log_name else None
+            spotty_process = self.__process_manager.spawn(
+                log_name or "spotty",
+                lambda: SpottyProcess(
+                    args,
+                    log_watcher,
+                    startupinfo=startupinfo,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=self.__spotty_rust_env,
+                ),
             )
+            apply_scheduling_policy(spotty_process.pid, role, self.__cpus)
+            if log_watcher:
+                log_watcher.start(spotty_process)
+            return spotty_process
         except Exception as ex:
             raise Exception(f"Run spotty error: {ex}")
@@ -1,16 +1,26 @@
 import struct
 import subprocess
+import threading
+import time
 from io import BytesIO
-from typing import Callable, Tuple
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Union
 
 from xbmc import LOGDEBUG, LOGWARNING, LOGERROR
 
 from spotty import Spotty
-from utils import bytes_to_megabytes, kill_process_by_pid, log_msg, log_exception
+from spotty_decoder_slots import SpottyDecoderSlots
+from spotty_pcm_spool import SpottyPcmSpool, SpooledTrack, get_spool_key
+from spotty_range_stream import SpottyRangeStream, StreamRegion
+from spotty_track_buffer import SpottyTrackBuffer
+from spotty_warm_pool import SpottyWarmPool
+from utils import bytes_to_megabytes, log_msg, log_exception
 
 SPOTIFY_TRACK_PREFIX = "spotify:track:"
 # SPOTTY_AUDIO_CHUNK_SIZE = 20*1024
 SPOTTY_AUDIO_CHUNK_SIZE = 524288
+# Streams start with small chunks, so the first audio goes out as soon as there is some.
+# The chunk size then doubles, up to 'SPOTTY_AUDIO_CHUNK_SIZE', while the client keeps up.
+FIRST_AUDIO_CHUNK_SIZE = 16384
 
 SPOTIFY_BITRATE = "320"
 SPOTTY_INITIAL_VOLUME = "50"
@@ -27,151 +37,693 @@ SPOTTY_STREAMING_NORMALIZATION_ARGS = [
     SPOTTY_GAIN_TYPE,
 ]
 
+WAV_SAMPLE_RATE = 44100
+WAV_CHANNELS = 2
+WAV_BITS_PER_SAMPLE = 16
+WAV_BLOCK_ALIGN = WAV_CHANNELS * (WAV_BITS_PER_SAMPLE // 8)
+WAV_BYTE_RATE = WAV_SAMPLE_RATE * WAV_BLOCK_ALIGN
+# Main header (12 bytes) + format chunk (24 bytes) + data chunk id and size (8 bytes).
+WAV_HEADER_LENGTH = 44
+
+# A range starting further than this past what the track buffer already holds gets its
+# own spotty started at the range's time offset, rather than waiting for the decode.
+SEEK_AHEAD_THRESHOLD_IN_BYTES = 10 * WAV_BYTE_RATE
+
+
+ADMISSION_TIMEOUT_IN_SECS = 10
+SEEK_ADMISSION_TIMEOUT_IN_SECS = 2
+
+TrackBuffer = Union[SpottyTrackBuffer, SpooledTrack]
+
+
+class SpottyStreamSession:
+    """One HTTP request's view of a track. Sessions for the same track share its buffer,
+    but each has its own range, seek buffer and cancellation."""
+
+    def __init__(
+        self,
+        session_id: int,
+        track_buffer: TrackBuffer,
+        use_normalization: bool,
+        request_time: float,
+    ):
+        self.session_id = session_id
+        self.track_buffer = track_buffer
+        self.use_normalization = use_normalization
+        self.closed = False
+        # Set to make the session stop waiting for audio and end its stream.
+        self.cancelled = threading.Event()
+        self.seek_buffer: Union[SpottyTrackBuffer, None] = None
+        # When the stream was requested, and how long it took to send the first audio byte
+        # after the wav header.
+        self.request_time = request_time
+        self.time_to_first_audio_byte: Union[float, None] = None
+        # Times the client caught up with the decoder after the first audio, and the least
+        # audio buffered ahead of the client in that time.
+        self.underrun_count = 0
+        self.min_read_ahead: Union[int, None] = None
+        self.last_read_ahead = 0
+
+    @property
+    def track_id(self) -> str:
+        return self.track_buffer.track_id
+
+    @property
+    def track_length(self) -> int:
+        return self.track_buffer.track_length
+
+    @property
+    def key(self) -> str:
+        return get_spool_key(self.track_id, self.use_normalization)
+
 
 class SpottyAudioStreamer:
-    def __init__(self, spotty: Spotty):
+    def __init__(self, spotty: Spotty, pcm_spool: SpottyPcmSpool, max_decoders: int):
         self.__spotty = spotty
-
-        self.__track_id: str = ""
-        self.__track_duration: int = 0
-        self.__wav_header: bytes = bytes()
-        self.__track_length: int = 0
+        self.__pcm_spool = pcm_spool
+        self.__decoder_slots = SpottyDecoderSlots(max_decoders)
 
         self.__notify_track_finished: Callable[[str], None] = lambda x: None
-        self.__last_spotty_pid = -1
-        self.__terminated = False
+
+        # Track buffers shared by all sessions, keyed by spool key. A buffer stays here while
+        # it has sessions or its spotty is still decoding, so a follow-up range request for
+        # the track, or a replay, finds it.
+        self.__track_buffers: Dict[str, TrackBuffer] = dict()
+        self.__session_counts: Dict[str, int] = dict()
+        self.__finished_notified_keys: Set[str] = set()
+        self.__track_buffers_lock = threading.RLock()
+        self.__last_session_id = 0
+        # Open sessions by id. Waiters for a track handoff are told when one closes.
+        self.__sessions: Dict[int, SpottyStreamSession] = dict()
+        self.__sessions_changed = threading.Condition(self.__track_buffers_lock)
+        self.__last_session_closed_time = 0.0
+        self.__stopped = False
+
+        # Keys of upcoming tracks being decoded ahead of time.
+        self.__prefetch_keys: List[str] = []
+        self.__warm_pool = SpottyWarmPool(self.__spawn_spotty)
+
+        # How far a decoder may get ahead of its slowest reader, and how much audio a stream
+        # waits for before sending any. Zero means no limit and no waiting.
+        self.__read_ahead_limit = 0
+        self.__prebuffer_len = 0
+        # A decoder producing nothing for this long is replaced. Zero means never.
+        self.__stall_timeout_in_secs = 0
 
         self.use_normalization = True
 
-    def get_track_length(self) -> int:
-        return self.__track_length
+    def set_notify_track_finished(self, func: Callable[[str], None]) -> None:
+        self.__notify_track_finished = func
 
-    def get_track_duration(self) -> int:
-        return self.__track_duration
+    def set_max_decoders(self, max_decoders: int) -> None:
+        self.__decoder_slots.set_max_decoders(max_decoders)
 
-    def set_track(self, track_id: str, track_duration: float) -> None:
-        self.__track_id = track_id
-        self.__track_duration = int(track_duration)
-        self.__wav_header, self.__track_length = self.__create_wav_header()
+    def set_stream_buffering(self, read_ahead_ms: int, prebuffer_ms: int) -> None:
+        """The read-ahead limit applies to decoders started from now on."""
+        self.__read_ahead_limit = self.__ms_to_bytes(read_ahead_ms)
+        self.__prebuffer_len = self.__ms_to_bytes(prebuffer_ms)
 
-    def set_notify_track_finished(self, func: Callable[[str], None]) -> None:
-        self.__notify_track_finished = func
+    def set_stall_timeout(self, stall_timeout_in_secs: int) -> None:
+        """Applies to decoders started from now on."""
+        self.__stall_timeout_in_secs = stall_timeout_in_secs
 
-    def terminate_stream(self) -> bool:
-        self.__terminated = True
-        if self.__last_spotty_pid == -1:
-            return False
-        self.__kill_last_spotty()
-        return True
+    def is_streaming_track(self, track_id: str) -> bool:
+        with self.__track_buffers_lock:
+            return self.__session_counts.get(get_spool_key(track_id, self.use_normalization), 0) > 0
 
-    def send_part_audio_stream(self, range_len: int, range_begin: int) -> str:
-        """Chunked transfer of audio data from spotty binary"""
+    @staticmethod
+    def get_track_length(track_duration: float) -> int:
+        """The length of a track's wav stream, header included, as its buffer will have it."""
+        return WAV_HEADER_LENGTH + WAV_SAMPLE_RATE * int(track_duration) * WAV_BLOCK_ALIGN
+
+    def open_session(
+        self, track_id: str, track_duration: float
+    ) -> Union[SpottyStreamSession, None]:
+        """Returns None if no decoder could be admitted for the track."""
+        request_time = time.monotonic()
+        use_normalization = self.use_normalization
+        key = get_spool_key(track_id, use_normalization)
+
+        with self.__track_buffers_lock:
+            self.__stop_abandoned_decoders(key)
+            track_buffer = self.__get_reusable_track_buffer(key)
+            if track_buffer:
+                return self.__add_session(key, track_buffer, use_normalization, request_time)
+
+            # A replay or seek in an already spooled track needs no spotty at all.
+            spooled_track = self.__pcm_spool.open_track(track_id, use_normalization)
+            if spooled_track:
+                self.__track_buffers[key] = spooled_track
+                return self.__add_session(key, spooled_track, use_normalization, request_time)
+
+        if not self.__decoder_slots.acquire(ADMISSION_TIMEOUT_IN_SECS, self.__preempt_idle_decoder):
+            return None
+
+        with self.__track_buffers_lock:
+            # Another request may have started this track while we waited for a slot.
+            track_buffer = self.__get_reusable_track_buffer(key)
+            if track_buffer:
+                self.__decoder_slots.release()
+                return self.__add_session(key, track_buffer, use_normalization, request_time)
+
+            track_buffer = self.__start_track_buffer(
+                track_id, int(track_duration), use_normalization
+            )
+            return self.__add_session(key, track_buffer, use_normalization, request_time)
+
+    def close_session(self, session: SpottyStreamSession) -> None:
+        with self.__track_buffers_lock:
+            if session.closed:
+                return
+            session.closed = True
+            self.__sessions.pop(session.session_id, None)
+            self.__last_session_closed_time = time.monotonic()
+            self.__sessions_changed.notify_all()
+            # The session's buffer may have been stopped and replaced since it was opened.
+            if self.__track_buffers.get(session.key) is not session.track_buffer:
+                return
+            self.__session_counts[session.key] -= 1
+            log_msg(
+                f"Closed stream session {session.session_id} for track '{session.track_id}'."
+                f" {self.__session_counts[session.key]} session(s) left on the track.",
+                LOGDEBUG,
+            )
+            self.__release_idle_track_buffer(session.key)
+
+    def cancel_session(self, session: SpottyStreamSession) -> None:
+        """End the session's stream now, even if it is waiting for audio."""
+        session.cancelled.set()
+        session.track_buffer.wake_readers()
+        seek_buffer = session.seek_buffer
+        if seek_buffer:
+            seek_buffer.wake_readers()
+
+    def wait_for_track_handoff(self, track_id: str, gap_in_secs: float) -> None:
+        """Wait for streams of other tracks to end, at most 'gap_in_secs', then until
+        'gap_in_secs' after that. Gives whatever played the previous track time to finish.
+        Returns straight away once streaming is stopped."""
+        key = get_spool_key(track_id, self.use_normalization)
+        start_time = time.monotonic()
+        with self.__sessions_changed:
+            self.__sessions_changed.wait_for(
+                lambda: self.__stopped
+                or all(session.key == key for session in self.__sessions.values()),
+                gap_in_secs,
+            )
+            gap_end_time = max(start_time, self.__last_session_closed_time) + gap_in_secs
+            self.__sessions_changed.wait_for(
+                lambda: self.__stopped, max(0.0, gap_end_time - time.monotonic())
+            )
+
+    def prefetch_tracks(self, tracks: List[Tuple[str, float]], max_bytes_per_track: int) -> None:
+        """Start decoding the given upcoming tracks, each up to 'max_bytes_per_track' bytes,
+        so their first request does not wait for a cold spotty start. Prefetching never waits
+        for a decoder slot."""
+        with self.__track_buffers_lock:
+            use_normalization = self.use_normalization
+            wanted_keys = []
+            for track_id, track_duration in tracks:
+                key = get_spool_key(track_id, use_normalization)
+                wanted_keys.append(key)
+                if key in self.__track_buffers or self.__pcm_spool.contains(
+                    track_id, use_normalization
+                ):
+                    continue
+                if not self.__decoder_slots.try_acquire():
+                    log_msg(f"No free decoder to prefetch track '{track_id}'.", LOGDEBUG)
+                    break
+
+                log_msg(f"Prefetching track '{track_id}'.", LOGDEBUG)
+                self.__start_track_buffer(
+                    track_id, int(track_duration), use_normalization, max_bytes_per_track
+                )
+                self.__session_counts[key] = 0
+                self.__prefetch_keys.append(key)
+
+            for key in list(self.__prefetch_keys):
+                if key not in wanted_keys:
+                    log_msg(f"Dropping prefetched '{key}'. No longer upcoming.", LOGDEBUG)
+                    self.__remove_track_buffer(key)
+
+    def terminate_prefetching(self) -> None:
+        with self.__track_buffers_lock:
+            for key in list(self.__prefetch_keys):
+                self.__remove_track_buffer(key)
+
+    def set_warm_pool_size(self, max_size: int) -> None:
+        self.__warm_pool.set_max_size(max_size)
+
+    def warm_tracks(self, track_ids: List[str]) -> None:
+        """Keep logged in spotty processes ready for tracks further ahead than the prefetched
+        ones. These cost no buffer space until their first request."""
+        use_normalization = self.use_normalization
+        self.__warm_pool.warm(
+            [
+                (track_id, use_normalization)
+                for track_id in track_ids
+                if not self.__pcm_spool.contains(track_id, use_normalization)
+            ]
+        )
+
+    def stop_warm_pool(self) -> None:
+        self.__warm_pool.stop()
+
+    def terminate_all_streams(self) -> bool:
+        with self.__track_buffers_lock:
+            self.__stopped = True
+            self.__sessions_changed.notify_all()
+            for session in list(self.__sessions.values()):
+                self.cancel_session(session)
+            keys = list(self.__track_buffers.keys())
+            for key in keys:
+                self.__remove_track_buffer(key)
+        return len(keys) > 0
+
+    def open_range_stream(
+        self, session: SpottyStreamSession, range_len: int, range_begin: int
+    ) -> SpottyRangeStream:
+        """The session's range as a file-like response body. Closing it closes the session."""
+        return SpottyRangeStream(
+            self.__send_part_audio_stream(session, range_len, range_begin),
+            lambda: self.cancel_session(session),
+            lambda: self.close_session(session),
+        )
+
+    def __send_part_audio_stream(
+        self, session: SpottyStreamSession, range_len: int, range_begin: int
+    ) -> Iterator[StreamRegion]:
+        """Chunked transfer of audio data from the session's track buffer. Yields each part
+        once it's buffered, and moves on when the consumer has sent all of it."""
 
-        self.__terminated = False
-        spotty_process = None
         bytes_sent = 0
+        seek_buffer = None
+        source_buffer = session.track_buffer
         try:
-            self.__kill_last_spotty()
+            self.__log_start_transfer(session, range_begin)
+            if range_begin == 0:
+                self.__log_send_wav_header(session.track_id)
 
-            self.__log_start_transfer(range_begin)
+            if self.__needs_seek_buffer(session.track_buffer, range_begin):
+                seek_buffer = self.__start_seek_buffer(session, range_begin)
+                if seek_buffer:
+                    source_buffer = seek_buffer
+                    session.seek_buffer = seek_buffer
 
-            # Send the wav header.
-            if range_begin == 0:
-                bytes_sent = len(self.__wav_header)
-                self.__log_send_wav_header()
-                yield self.__wav_header
-
-            track_id_uri = SPOTIFY_TRACK_PREFIX + self.__track_id
-            self.__log_start_reading_audio(track_id_uri)
-
-            # Execute the spotty process, then collect stdout.
-            args = SPOTTY_STREAMING_DEFAULT_ARGS.copy()
-            if self.use_normalization:
-                args += SPOTTY_STREAMING_NORMALIZATION_ARGS
-            args += ["--single-track", track_id_uri]
-            spotty_process = self.__spotty.run_spotty(args, use_creds=True)
-            self.__log_spotty_return_code(spotty_process)
-            self.__last_spotty_pid = spotty_process.pid
-
-            # Ignore the first x bytes to match the range request.
-            if range_begin != 0:
-                spotty_process.stdout.read(range_begin)
+            source_buffer.set_reader_offset(session.session_id, range_begin)
+            self.__wait_for_prebuffer(session, source_buffer, range_begin, range_len)
 
             # Loop as long as there's something to output.
+            chunk_size = FIRST_AUDIO_CHUNK_SIZE
             while bytes_sent < range_len:
-                if self.__terminated:
+                offset = range_begin + bytes_sent
+                if session.time_to_first_audio_byte is not None:
+                    self.__update_read_ahead_stats(session, source_buffer, offset)
+                frame_len = source_buffer.wait_readable(
+                    offset, min(chunk_size, range_len - bytes_sent), session.cancelled
+                )
+                if not frame_len:
+                    if session.cancelled.is_set():
+                        self.__log_cancelled_sending(session, bytes_sent)
+                    elif not source_buffer.is_terminated():
+                        log_msg("Nothing read from track buffer.", LOGERROR)
                     return
 
-                frame = spotty_process.stdout.read(SPOTTY_AUDIO_CHUNK_SIZE)
-                if self.__terminated:
-                    return
-                if not frame:
-                    log_msg("Nothing read from stdout.", LOGERROR)
-                    break
+                send_start_time = time.monotonic()
+                if session.time_to_first_audio_byte is None and (
+                    offset + frame_len > WAV_HEADER_LENGTH
+                ):
+                    self.__record_time_to_first_audio_byte(session, send_start_time)
 
-                bytes_sent += len(frame)
-                self.__log_continue_sending(bytes_sent)
-                yield frame
+                yield source_buffer, offset, frame_len
+                bytes_sent += frame_len
+                source_buffer.set_reader_offset(session.session_id, offset + frame_len)
+                self.__log_continue_sending(session, bytes_sent)
+                chunk_size = self.__get_next_chunk_size(
+                    chunk_size, frame_len, time.monotonic() - send_start_time
+                )
 
             # All done.
-            self.__notify_track_finished(self.__track_id)
-            self.__log_finished_sending(range_begin, bytes_sent)
+            if range_begin + bytes_sent >= session.track_length:
+                self.__notify_track_finished_once(session)
+            self.__log_finished_sending(session.track_id, range_begin, bytes_sent)
 
         except Exception as ex:
-            self.__log_exception_sending(ex, range_begin, bytes_sent)
+            self.__log_exception_sending(session.track_id, ex, range_begin, bytes_sent)
         finally:
-            # Make sure spotty always gets terminated.
-            if spotty_process:
-                self.__last_spotty_pid = -1
-                spotty_process.terminate()
-                spotty_process.communicate()
-                # Make really sure!
-                kill_process_by_pid(spotty_process.pid)
-
-    def __kill_last_spotty(self) -> None:
-        if self.__last_spotty_pid == -1:
+            source_buffer.remove_reader(session.session_id)
+            self.__log_stream_stats(session, source_buffer)
+            if seek_buffer:
+                seek_buffer.terminate()
+            self.close_session(session)
+
+    def __wait_for_prebuffer(
+        self,
+        session: SpottyStreamSession,
+        source_buffer: TrackBuffer,
+        range_begin: int,
+        range_len: int,
+    ) -> None:
+        prebuffer_len = self.__prebuffer_len
+        if self.__read_ahead_limit:
+            # The decoder would never get further ahead of this reader than its limit.
+            prebuffer_len = min(prebuffer_len, self.__read_ahead_limit)
+        if not prebuffer_len:
+            return
+
+        start_time = time.monotonic()
+        source_buffer.wait_readable(
+            range_begin + min(prebuffer_len, range_len) - 1, 1, session.cancelled
+        )
+        log_msg(
+            f"Prebuffered track '{session.track_id}' (session {session.session_id})"
+            f" in {time.monotonic() - start_time:.3f}s.",
+            LOGDEBUG,
+        )
+
+    @staticmethod
+    def __update_read_ahead_stats(
+        session: SpottyStreamSession, source_buffer: TrackBuffer, offset: int
+    ) -> None:
+        read_ahead = max(0, source_buffer.get_bytes_buffered() - offset)
+        if read_ahead == 0 and session.last_read_ahead > 0:
+            session.underrun_count += 1
+        session.last_read_ahead = read_ahead
+        if session.min_read_ahead is None or read_ahead < session.min_read_ahead:
+            session.min_read_ahead = read_ahead
+
+    @staticmethod
+    def __get_next_chunk_size(chunk_size: int, frame_len: int, send_secs: float) -> int:
+        """Grow the chunk while the client takes audio faster than it plays, and shrink it
+        again if the client falls behind."""
+        play_secs = frame_len / WAV_BYTE_RATE
+        if send_secs < play_secs:
+            return min(2 * chunk_size, SPOTTY_AUDIO_CHUNK_SIZE)
+        if send_secs > 2 * play_secs:
+            return max(chunk_size // 2, FIRST_AUDIO_CHUNK_SIZE)
+        return chunk_size
+
+    @staticmethod
+    def __record_time_to_first_audio_byte(session: SpottyStreamSession, send_time: float) -> None:
+        session.time_to_first_audio_byte = send_time - session.request_time
+        log_msg(
+            f"Time to first audio byte for track '{session.track_id}'"
+            f" (session {session.session_id}): {session.time_to_first_audio_byte:.3f}s.",
+            LOGDEBUG,
+        )
+
+    def __add_session(
+        self, key: str, track_buffer: TrackBuffer, use_normalization: bool, request_time: float
+    ) -> SpottyStreamSession:
+        if key in self.__prefetch_keys:
+            log_msg(f"Using prefetched buffer for track '{track_buffer.track_id}'.", LOGDEBUG)
+            self.__prefetch_keys.remove(key)
+            track_buffer.remove_byte_limit()
+
+        self.__last_session_id += 1
+        self.__session_counts[key] = self.__session_counts.get(key, 0) + 1
+        log_msg(
+            f"Opened stream session {self.__last_session_id} for track '{track_buffer.track_id}'."
+            f" {self.__session_counts[key]} session(s) on the track.",
+            LOGDEBUG,
+        )
+        session = SpottyStreamSession(
+            self.__last_session_id, track_buffer, use_normalization, request_time
+        )
+        self.__sessions[session.session_id] = session
+        return session
+
+    def __get_reusable_track_buffer(self, key: str) -> Union[TrackBuffer, None]:
+        track_buffer = self.__track_buffers.get(key)
+        if track_buffer and not track_buffer.is_terminated():
+            return track_buffer
+        return None
+
+    def __start_track_buffer(
+        self, track_id: str, track_duration: int, use_normalization: bool, byte_limit: int = 0
+    ) -> SpottyTrackBuffer:
+        """Needs a decoder slot, which the buffer gives back once its spotty is done."""
+        key = get_spool_key(track_id, use_normalization)
+        spool_file = None
+        try:
+            wav_header, track_length = self.__create_wav_header(track_duration)
+            spool_file = self.__pcm_spool.create_spool_file(
+                track_id, use_normalization, track_length
+            )
+            track_buffer = SpottyTrackBuffer(
+                track_id,
+                wav_header,
+                track_length,
+                spool_file,
+                self.__pcm_spool.commit,
+                self.__pcm_spool.discard,
+                byte_limit,
+                on_finished=lambda: self.__on_track_buffer_finished(key),
+                read_ahead_limit=self.__read_ahead_limit,
+                resume_spotty=lambda offset: self.__resume_spotty(
+                    track_id, use_normalization, offset
+                ),
+                stall_timeout_in_secs=self.__stall_timeout_in_secs,
+            )
+        except Exception:
+            # There's no buffer to give the slot back, e.g. with the spool's disk full.
+            if spool_file:
+                self.__pcm_spool.discard(spool_file)
+            self.__decoder_slots.release()
+            raise
+
+        self.__track_buffers[key] = track_buffer
+        self.__finished_notified_keys.discard(key)
+        try:
+            track_buffer.start(self.__start_spotty(track_id, use_normalization))
+        except Exception:
+            # Terminating a buffer that isn't started gives its slot back.
+            self.__remove_track_buffer(key)
+            raise
+
+        return track_buffer
+
+    def __on_track_buffer_finished(self, key: str) -> None:
+        self.__decoder_slots.release()
+        with self.__track_buffers_lock:
+            self.__release_idle_track_buffer(key)
+
+    def __release_idle_track_buffer(self, key: str) -> None:
+        # Keep a buffer nobody is reading while its spotty still decodes into the spool,
+        # or while it is being prefetched.
+        if self.__session_counts.get(key, 0) > 0 or key in self.__prefetch_keys:
             return
-        kill_process_by_pid(self.__last_spotty_pid)
-        self.__last_spotty_pid = -1
+        track_buffer = self.__track_buffers.get(key)
+        if isinstance(track_buffer, SpottyTrackBuffer) and track_buffer.is_producing():
+            return
+        self.__remove_track_buffer(key)
+
+    def __stop_abandoned_decoders(self, playing_key: str) -> None:
+        """On moving to another track, stop idle decoders whose tracks the spool would not
+        keep anyway. Their decoding is wasted once nothing reads it."""
+        for key, track_buffer in list(self.__track_buffers.items()):
+            if (
+                key != playing_key
+                and self.__session_counts.get(key, 0) == 0
+                and key not in self.__prefetch_keys
+                and isinstance(track_buffer, SpottyTrackBuffer)
+                and not self.__pcm_spool.would_keep(track_buffer.track_length)
+            ):
+                log_msg(f"Stopping decoder for abandoned track '{key}'.", LOGDEBUG)
+                self.__remove_track_buffer(key)
+
+    def __remove_track_buffer(self, key: str) -> None:
+        track_buffer = self.__track_buffers.pop(key, None)
+        self.__session_counts.pop(key, None)
+        if key in self.__prefetch_keys:
+            self.__prefetch_keys.remove(key)
+        if track_buffer:
+            track_buffer.terminate()
+
+    def __preempt_idle_decoder(self) -> bool:
+        """Stop the oldest decoder that no session is reading, leaving prefetches till last."""
+        with self.__track_buffers_lock:
+            idle_keys = [
+                key
+                for key, track_buffer in self.__track_buffers.items()
+                if self.__session_counts.get(key, 0) == 0
+                and isinstance(track_buffer, SpottyTrackBuffer)
+                and track_buffer.is_producing()
+            ]
+            if not idle_keys:
+                return False
+            idle_keys.sort(key=lambda k: k in self.__prefetch_keys)
+            log_msg(f"Stopping idle decoder '{idle_keys[0]}' to admit a new stream.", LOGDEBUG)
+            self.__remove_track_buffer(idle_keys[0])
+            return True
 
-    def __log_start_transfer(self, range_begin: int) -> None:
+    @staticmethod
+    def __needs_seek_buffer(track_buffer: TrackBuffer, range_begin: int) -> bool:
+        if isinstance(track_buffer, SpooledTrack):
+            return False
+        return range_begin > track_buffer.get_bytes_buffered() + SEEK_AHEAD_THRESHOLD_IN_BYTES
+
+    def __start_seek_buffer(
+        self, session: SpottyStreamSession, range_begin: int
+    ) -> Union[SpottyTrackBuffer, None]:
+        if not self.__decoder_slots.acquire(
+            SEEK_ADMISSION_TIMEOUT_IN_SECS, self.__preempt_idle_decoder
+        ):
+            log_msg("No free decoder to seek. Waiting for the track buffer instead.")
+            return None
+
+        # Start spotty at the last whole second before the range. The seek buffer then
+        # holds the track from that second's first sample on, so reads at 'range_begin'
+        # get exactly the sample-aligned bytes they would from a full decode.
+        start_position_secs, start_offset = self.__get_start_position(range_begin)
         log_msg(
-            f"Start transfer for track '{self.__track_id}' - range begin: {range_begin}",
+            f"Seeking track '{session.track_id}' to {start_position_secs}s"
+            f" for range begin {range_begin}.",
             LOGDEBUG,
         )
-        log_msg(f"Use Spotify normalization: {self.use_normalization}.", LOGDEBUG)
 
-    def __log_send_wav_header(self) -> None:
+        seek_file = self.__pcm_spool.create_seek_file(
+            session.track_id, session.use_normalization, session.track_length - start_offset
+        )
+        seek_buffer = SpottyTrackBuffer(
+            session.track_id,
+            bytes(),
+            session.track_length,
+            seek_file,
+            self.__pcm_spool.discard,
+            self.__pcm_spool.discard,
+            start_offset=start_offset,
+            on_finished=self.__decoder_slots.release,
+            read_ahead_limit=self.__read_ahead_limit,
+            resume_spotty=lambda offset: self.__resume_spotty(
+                session.track_id, session.use_normalization, offset
+            ),
+            stall_timeout_in_secs=self.__stall_timeout_in_secs,
+        )
+        try:
+            seek_buffer.start(
+                self.__start_spotty(
+                    session.track_id, session.use_normalization, start_position_secs
+                )
+            )
+        except Exception:
+            seek_buffer.terminate()
+            raise
+
+        return seek_buffer
+
+    def __resume_spotty(
+        self, track_id: str, use_normalization: bool, offset: int
+    ) -> Tuple[subprocess.Popen, int]:
+        """A new spotty for a buffer whose spotty stalled at 'offset', and how many bytes of
+        its output to drop to get back to 'offset'."""
+        start_position_secs, start_offset = self.__get_start_position(offset)
+        return self.__start_spotty(track_id, use_normalization, start_position_secs), (
+            offset - start_offset
+        )
+
+    @staticmethod
+    def __get_start_position(offset: int) -> Tuple[int, int]:
+        """The last whole second at or before track 'offset', and that second's offset."""
+        start_position_secs = max(0, offset - WAV_HEADER_LENGTH) // WAV_BYTE_RATE
+        return start_position_secs, WAV_HEADER_LENGTH + start_position_secs * WAV_BYTE_RATE
+
+    def __start_spotty(
+        self, track_id: str, use_normalization: bool, start_position_secs: int = 0
+    ) -> subprocess.Popen:
+        if start_position_secs == 0:
+            spotty_process = self.__warm_pool.take(track_id, use_normalization)
+            if spotty_process:
+                return spotty_process
+        return self.__spawn_spotty(track_id, use_normalization, start_position_secs)
+
+    def __spawn_spotty(
+        self, track_id: str, use_normalization: bool, start_position_secs: int = 0
+    ) -> subprocess.Popen:
+        track_id_uri = SPOTIFY_TRACK_PREFIX + track_id
+        self.__log_start_reading_audio(track_id_uri)
+
+        # Execute the spotty process. The track buffer collects stdout.
+        args = SPOTTY_STREAMING_DEFAULT_ARGS.copy()
+        if use_normalization:
+            args += SPOTTY_STREAMING_NORMALIZATION_ARGS
+        args += ["--single-track", track_id_uri]
+        if start_position_secs > 0:
+            args += ["--start-position", str(start_position_secs)]
+        spotty_process = self.__spotty.run_spotty(args, use_creds=True, log_name=track_id)
+        self.__log_spotty_return_code(spotty_process)
+
+        return spotty_process
+
+    def __notify_track_finished_once(self, session: SpottyStreamSession) -> None:
+        with self.__track_buffers_lock:
+            if session.key in self.__finished_notified_keys:
+                return
+            self.__finished_notified_keys.add(session.key)
+        self.__notify_track_finished(session.track_id)
+
+    @staticmethod
+    def __log_start_transfer(session: SpottyStreamSession, range_begin: int) -> None:
+        log_msg(
+            f"Start transfer for track '{session.track_id}' (session {session.session_id})"
+            f" - range begin: {range_begin}",
+            LOGDEBUG,
+        )
+        log_msg(f"Use Spotify normalization: {session.use_normalization}.", LOGDEBUG)
+
+    @staticmethod
+    def __log_send_wav_header(track_id: str) -> None:
+        log_msg(
+            f"Sending wav header for track '{track_id}'.",
+            LOGDEBUG,
+        )
+
+    @staticmethod
+    def __log_start_reading_audio(track_id_uri: str) -> None:
+        log_msg(f"Start reading audio data for track: '{track_id_uri}'.", LOGDEBUG)
+
+    def __log_continue_sending(self, session: SpottyStreamSession, bytes_sent: int) -> None:
         log_msg(
-            f"Sending wav header for track '{self.__track_id}'.",
+            f"Continue sending track '{session.track_id}' (session {session.session_id})"
+            f" - {self.__get_data_sent_str(bytes_sent, session.track_length)}.",
             LOGDEBUG,
         )
 
-    def __log_start_reading_audio(self, track_id_uri: str) -> None:
+    @staticmethod
+    def __log_stream_stats(session: SpottyStreamSession, source_buffer: TrackBuffer) -> None:
+        min_read_ahead_ms = (
+            "-"
+            if session.min_read_ahead is None
+            else f"{1000 * session.min_read_ahead // WAV_BYTE_RATE}ms"
+        )
         log_msg(
-            f"Start reading audio data for track: '{track_id_uri}',"
-            f" length = {self.__track_length} ({self.__get_mb_str(self.__track_length)}).",
+            f"Stream stats for track '{session.track_id}' (session {session.session_id}):"
+            f" {session.underrun_count} underrun(s), lowest read-ahead {min_read_ahead_ms},"
+            f" {source_buffer.get_overrun_count()} decoder overrun(s),"
+            f" {source_buffer.get_stall_count()} decoder stall(s),"
+            f" {source_buffer.get_resume_count()} decoder resume(s).",
             LOGDEBUG,
         )
 
-    def __log_continue_sending(self, bytes_sent: int) -> None:
+    def __log_cancelled_sending(self, session: SpottyStreamSession, bytes_sent: int) -> None:
         log_msg(
-            f"Continue sending track '{self.__track_id}'"
-            f" - {self.__get_data_sent_str(bytes_sent, self.__track_length)}.",
+            f"Cancelled sending track '{session.track_id}' (session {session.session_id})"
+            f" - {self.__get_data_sent_str(bytes_sent, session.track_length)}.",
             LOGDEBUG,
         )
 
-    def __log_finished_sending(self, range_begin: int, bytes_sent: int) -> None:
+    def __log_finished_sending(self, track_id: str, range_begin: int, bytes_sent: int) -> None:
         log_msg(
-            f"Finished sending track '{self.__track_id}'"
+            f"Finished sending track '{track_id}'"
             f" - range begin {range_begin}"
             f" - range end {bytes_sent} - {self.__get_mb_str(bytes_sent)}.",
             LOGDEBUG,
         )
 
-    def __log_exception_sending(self, ex: Exception, range_begin: int, bytes_sent: int) -> None:
+    def __log_exception_sending(
+        self, track_id: str, ex: Exception, range_begin: int, bytes_sent: int
+    ) -> None:
         log_msg(
-            f"EXCEPTION sending track '{self.__track_id}'"
+            f"EXCEPTION sending track '{track_id}'"
             f" - range begin {range_begin}"
             f" - range end {bytes_sent} - {self.__get_mb_str(bytes_sent)}.",
             LOGERROR,
@@ -197,15 +749,21 @@ class SpottyAudioStreamer:
         percent = int(100.0 * float(data_bytes) / float(track_length))
         return f"sent so far: {data_mb:>5.1f}MB ({percent:>3}%)"
 
-    def __create_wav_header(self) -> Tuple[bytes, int]:
+    @staticmethod
+    def __ms_to_bytes(milliseconds: int) -> int:
+        """Whole sample frames of audio for the given time."""
+        return milliseconds * WAV_BYTE_RATE // 1000 // WAV_BLOCK_ALIGN * WAV_BLOCK_ALIGN
+
+    @staticmethod
+    def __create_wav_header(track_duration: int) -> Tuple[bytes, int]:
         """generate a wav header for the stream"""
         try:
-            log_msg(f"Start getting wav header. Duration = {self.__track_duration}", LOGDEBUG)
+            log_msg(f"Start getting wav header. Duration = {track_duration}", LOGDEBUG)
             file = BytesIO()
-            num_samples = 44100 * self.__track_duration
-            channels = 2
-            sample_rate = 44100
-            bits_per_sample = 16
+            num_samples = WAV_SAMPLE_RATE * track_duration
+            channels = WAV_CHANNELS
+            sample_rate = WAV_SAMPLE_RATE
+            bits_per_sample = WAV_BITS_PER_SAMPLE
 
             # Generate format chunk.
             format_chunk_spec = "<4sLHHLLHH"
@@ -1,7 +1,9 @@
+import json
 import time
 from typing import Dict
 
 from spotty import Spotty
+from spotty_scheduling import SPOTTY_ROLE_TOKEN
 from utils import log_msg, log_exception, LOGDEBUG
 
 CLIENT_ID = "2eb96f9b37494be1824999d58028a305"
@@ -39,7 +41,9 @@ class SpottyAuth:
                 "--scope",
                 ",".join(SPOTTY_SCOPE),
             ]
-            spotty = self.__spotty.run_spotty(extra_args=args, use_creds=True)
+            spotty = self.__spotty.run_spotty(
+                extra_args=args, use_creds=True, role=SPOTTY_ROLE_TOKEN
+            )
 
             # done = Event()
             # watcher = Thread(target=kill_on_timeout, args=(done, 5, spotty))
@@ -51,10 +55,10 @@ class SpottyAuth:
 
             log_msg(f"Spotty stdout: {stdout}")
             result = None
-            for line in stdout.decode("utf-8").split():
+            for line in stdout.decode("utf-8").splitlines():
                 line = line.strip()
                 if line.startswith('{"accessToken"'):
-                    result = eval(line)
+                    result = json.loads(line)
 
             # Transform token info to spotipy compatible format.
             if result:
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+from xbmc import LOGDEBUG, LOGWARNING
+
+from utils import log_msg
+
+WAIT_RETRY_IN_SECS = 0.5
+# How long to wait for a stopped decoder to give back its slot before stopping another.
+MAKE_ROOM_WAIT_IN_SECS = 5
+
+
+class SpottyDecoderSlots:
+    """Caps the number of spotty processes decoding at the same time. Requests waiting for
+    a slot are admitted first come, first served."""
+
+    def __init__(self, max_decoders: int):
+        self.__max_decoders = max_decoders
+        self.__decoders_in_use = 0
+        self.__waiters = deque()
+        self.__slot_freed = threading.Condition()
+
+    def set_max_decoders(self, max_decoders: int) -> None:
+        with self.__slot_freed:
+            self.__max_decoders = max_decoders
+            self.__slot_freed.notify_all()
+
+    def get_decoders_in_use(self) -> int:
+        with self.__slot_freed:
+            return self.__decoders_in_use
+
+    def try_acquire(self) -> bool:
+        """Take a slot only if one is free and nobody is already waiting for one."""
+        with self.__slot_freed:
+            if self.__waiters or self.__decoders_in_use >= self.__max_decoders:
+                return False
+            self.__decoders_in_use += 1
+            return True
+
+    def acquire(self, timeout_in_secs: float, make_room: Callable[[], bool]) -> bool:
+        """Wait in line for a slot. When first in line and all slots are taken, 'make_room'
+        is asked to free one, e.g. by stopping a decoder nobody is listening to."""
+        ticket = object()
+        deadline = time.monotonic() + timeout_in_secs
+        last_made_room = 0.0
+        with self.__slot_freed:
+            self.__waiters.append(ticket)
+        try:
+            while True:
+                with self.__slot_freed:
+                    at_front = self.__waiters[0] is ticket
+                    if at_front and self.__decoders_in_use < self.__max_decoders:
+                        self.__decoders_in_use += 1
+                        return True
+                    remaining_secs = deadline - time.monotonic()
+                    if remaining_secs <= 0:
+                        log_msg(
+                            f"No decoder slot free after {timeout_in_secs}s"
+                            f" ({self.__decoders_in_use} in use).",
+                            LOGWARNING,
+                        )
+                        return False
+
+                # Don't hold the lock here. A stopped decoder releases its slot shortly after.
+                if at_front and time.monotonic() - last_made_room > MAKE_ROOM_WAIT_IN_SECS:
+                    if make_room():
+                        last_made_room = time.monotonic()
+                with self.__slot_freed:
+                    # Unless it can take a slot now, wait even with one free: it's for a
+                    # waiter ahead in line, which will wake the others once it has it.
+                    can_take_slot = (
+                        self.__waiters[0] is ticket and self.__decoders_in_use < self.__max_decoders
+                    )
+                    if not can_take_slot:
+                        self.__slot_freed.wait(min(remaining_secs, WAIT_RETRY_IN_SECS))
+        finally:
+            with self.__slot_freed:
+                self.__waiters.remove(ticket)
+                self.__slot_freed.notify_all()
+
+    def release(self) -> None:
+        with self.__slot_freed:
+            self.__decoders_in_use -= 1
+            log_msg(f"Released decoder slot. {self.__decoders_in_use} in use.", LOGDEBUG)
+            self.__slot_freed.notify_all()
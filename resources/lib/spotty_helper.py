@@ -1,9 +1,12 @@
+import hashlib
+import json
 import os
 import platform
 import shutil
 import stat
 import subprocess
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
 
 import xbmc
 import xbmcaddon
@@ -13,6 +16,8 @@ import spotty
 from utils import log_msg, log_exception, ADDON_ID, ADDON_DATA_PATH
 
 SPOTTY_SUBDIR = "deps/spotty"
+# The binary picked by self-testing candidates, so later starts can skip the tests.
+SPOTTY_DETECTION_CACHE_FILE = os.path.join(ADDON_DATA_PATH, "spotty-detection.json")
 
 
 class SpottyHelper:
@@ -38,15 +43,6 @@ class SpottyHelper:
             raise Exception("Could not get spotify password.")
         return spotify_password
 
-    def kill_all_spotties(self) -> None:
-        if platform.system() == "Windows":
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            subprocess.Popen(["taskkill", "/IM", "spotty.exe"], startupinfo=startupinfo, shell=True)
-        else:
-            sp_binary_file = os.path.basename(self.spotty_binary_path)
-            os.system("killall --quiet " + sp_binary_file)
-
     @staticmethod
     def __get_spotty_path() -> Union[str, None]:
         """find the correct spotty binary belonging to the platform"""
@@ -78,26 +74,41 @@ class SpottyHelper:
 
     @staticmethod
     def __get_android_spotty_path() -> Union[str, None]:
-        spotty_path = None
+        spotty_path = SpottyHelper.__get_cached_spotty_path("android")
+        if spotty_path:
+            return spotty_path
 
-        # Try by testing to get the correct binary path.
+        # Try by testing to get the correct binary path. Each candidate gets its own copy
+        # in the writable dir, so they can all be tested at once.
         candidate_paths = [
             ("arm-android", "spotty"),
             ("arm-android", "spotty-aarch64"),
             ("x86-android", "spotty"),
             ("x86-android", "spotty-x86_64"),
         ]
-        for path in candidate_paths:
+        test_binaries = {}
+        for index, path in enumerate(candidate_paths):
             binary = os.path.join(os.path.dirname(__file__), SPOTTY_SUBDIR, path[0], path[1])
-            test_binary = os.path.join(spotty.KODI_ANDROID_INTERNAL_WRITABLE_DIR, "spotty")
+            if not os.path.exists(binary):
+                continue
+            test_binary = os.path.join(
+                spotty.KODI_ANDROID_INTERNAL_WRITABLE_DIR, f"spotty-test-{index}"
+            )
             shutil.copyfile(binary, test_binary)
             os.chmod(test_binary, stat.S_IRWXU + stat.S_IRWXG + stat.S_IRWXO)
-            if SpottyHelper.__test_spotty(test_binary):
-                spotty_path = test_binary
-                log_msg(f"Found candidate spotty path: '{binary}'.")
-                break
-            os.remove(test_binary)
+            test_binaries[test_binary] = binary
 
+        working_binary = SpottyHelper.__find_first_working_spotty(list(test_binaries.keys()))
+        for test_binary, binary in test_binaries.items():
+            if test_binary != working_binary:
+                os.remove(test_binary)
+                continue
+            spotty_path = os.path.join(spotty.KODI_ANDROID_INTERNAL_WRITABLE_DIR, "spotty")
+            os.replace(test_binary, spotty_path)
+            log_msg(f"Found candidate spotty path: '{binary}'.")
+
+        if spotty_path:
+            SpottyHelper.__save_cached_spotty_path("android", spotty_path)
         return spotty_path
 
     @staticmethod
@@ -112,6 +123,10 @@ class SpottyHelper:
                 os.path.dirname(__file__), SPOTTY_SUBDIR, "x86-linux", "spotty-x86_64"
             )
         else:
+            spotty_path = SpottyHelper.__get_cached_spotty_path("linux")
+            if spotty_path:
+                return spotty_path
+
             # When we're unsure about the platform/cpu, try by testing to get
             # the correct binary path.
             candidate_paths = [
@@ -119,14 +134,88 @@ class SpottyHelper:
                 ("arm-linux", "spotty"),
                 ("x86-linux", "spotty"),
             ]
-            for path in candidate_paths:
-                binary = os.path.join(os.path.dirname(__file__), SPOTTY_SUBDIR, path[0], path[1])
-                if SpottyHelper.__test_spotty(binary):
-                    spotty_path = binary
-                    break
+            spotty_path = SpottyHelper.__find_first_working_spotty(
+                [
+                    os.path.join(os.path.dirname(__file__), SPOTTY_SUBDIR, path[0], path[1])
+                    for path in candidate_paths
+                ]
+            )
+            if spotty_path:
+                SpottyHelper.__save_cached_spotty_path("linux", spotty_path)
 
         return spotty_path
 
+    @staticmethod
+    def __find_first_working_spotty(binaries: List[str]) -> Union[str, None]:
+        """Self-test all the binaries at once and return the first one, in the given order,
+        that passed."""
+        if not binaries:
+            return None
+        with ThreadPoolExecutor(max_workers=len(binaries)) as executor:
+            test_results = list(executor.map(SpottyHelper.__test_spotty, binaries))
+        for binary, test_passed in zip(binaries, test_results):
+            if test_passed:
+                return binary
+        return None
+
+    @staticmethod
+    def __get_detection_key(platform_name: str) -> Dict[str, str]:
+        return {
+            "addon_version": xbmcaddon.Addon(id=ADDON_ID).getAddonInfo("version"),
+            "platform": platform_name,
+            "architecture": platform.machine(),
+        }
+
+    @staticmethod
+    def __get_cached_spotty_path(platform_name: str) -> Union[str, None]:
+        """The binary from an earlier detection, if it was made by this addon version on this
+        platform and the binary is unchanged since."""
+        try:
+            if not os.path.exists(SPOTTY_DETECTION_CACHE_FILE):
+                return None
+            with open(SPOTTY_DETECTION_CACHE_FILE, "r") as f:
+                detection = json.load(f)
+
+            if detection["key"] != SpottyHelper.__get_detection_key(platform_name):
+                log_msg("Addon or platform changed since the last spotty detection.")
+                return None
+            spotty_path = detection["binary"]
+            if not os.path.exists(spotty_path) or (
+                SpottyHelper.__get_checksum(spotty_path) != detection["checksum"]
+            ):
+                log_msg(f"Spotty binary '{spotty_path}' changed since the last detection.")
+                return None
+
+            log_msg(f"Using spotty binary '{spotty_path}' from the last detection.")
+            return spotty_path
+        except Exception as exc:
+            log_exception(exc, "Could not read the last spotty detection")
+            return None
+
+    @staticmethod
+    def __save_cached_spotty_path(platform_name: str, spotty_path: str) -> None:
+        try:
+            os.makedirs(os.path.dirname(SPOTTY_DETECTION_CACHE_FILE), exist_ok=True)
+            detection = {
+                "key": SpottyHelper.__get_detection_key(platform_name),
+                "binary": spotty_path,
+                "checksum": SpottyHelper.__get_checksum(spotty_path),
+            }
+            temp_file = SPOTTY_DETECTION_CACHE_FILE + ".tmp"
+            with open(temp_file, "w") as f:
+                json.dump(detection, f)
+            os.replace(temp_file, SPOTTY_DETECTION_CACHE_FILE)
+        except Exception as exc:
+            log_exception(exc, "Could not save the spotty detection")
+
+    @staticmethod
+    def __get_checksum(path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
     @classmethod
     def __test_spotty(cls, binary_path: str) -> bool:
         """self-test spotty binary"""
@@ -0,0 +1,82 @@
+import re
+import subprocess
+import threading
+import time
+from typing import List, NamedTuple
+
+from xbmc import LOGDEBUG, LOGWARNING
+
+from utils import log_msg, log_exception
+
+SPAWNED_EVENT = "spawned"
+AP_CONNECT_EVENT = "ap_connect"
+AUTHENTICATED_EVENT = "authenticated"
+TRACK_LOADED_EVENT = "track_loaded"
+FIRST_AUDIO_EVENT = "first_audio"
+
+# Startup milestones in spotty's (librespot's) log, in the order they happen.
+LOG_LINE_EVENTS = [
+    (re.compile(r"Connecting to AP"), AP_CONNECT_EVENT),
+    (re.compile(r"Authenticated as"), AUTHENTICATED_EVENT),
+    (re.compile(r"\(\d+ ms\) loaded"), TRACK_LOADED_EVENT),
+]
+LOG_LINE_PROBLEM_REGEX = re.compile(r"\b(WARN|ERROR)\b")
+
+
+class SpottyTimingEvent(NamedTuple):
+    name: str
+    # Seconds since the spotty process was started.
+    secs: float
+
+
+class SpottyLogWatcher:
+    """Reads a spotty process's stderr on a thread of its own, so the log never mixes with
+    the audio on stdout. Startup milestones in the log become timing events."""
+
+    def __init__(self, name: str, spawn_start_time: float):
+        self.__name = name
+        self.__spawn_start_time = spawn_start_time
+        self.__lock = threading.Lock()
+        self.__events: List[SpottyTimingEvent] = []
+
+    def start(self, spotty_process: subprocess.Popen) -> None:
+        self.record(SPAWNED_EVENT)
+        threading.Thread(target=self.__read_log, args=(spotty_process,), daemon=True).start()
+
+    def get_events(self) -> List[SpottyTimingEvent]:
+        with self.__lock:
+            return list(self.__events)
+
+    def record(self, event_name: str) -> None:
+        """Record the first occurrence of 'event_name'. Later ones are ignored."""
+        with self.__lock:
+            if any(event.name == event_name for event in self.__events):
+                return
+            self.__events.append(
+                SpottyTimingEvent(event_name, time.monotonic() - self.__spawn_start_time)
+            )
+            events = list(self.__events)
+
+        if event_name == FIRST_AUDIO_EVENT:
+            log_msg(
+                f"Spotty timings for '{self.__name}': "
+                + ", ".join(f"{e.name} {e.secs:.3f}s" for e in events)
+                + ".",
+                LOGDEBUG,
+            )
+
+    def __read_log(self, spotty_process: subprocess.Popen) -> None:
+        try:
+            with spotty_process.stderr:
+                for line in iter(spotty_process.stderr.readline, b""):
+                    self.__parse_line(line.decode("utf-8", errors="replace").rstrip())
+        except Exception as exc:
+            log_exception(exc, f"Error reading spotty log for '{self.__name}'")
+
+    def __parse_line(self, line: str) -> None:
+        for regex, event_name in LOG_LINE_EVENTS:
+            if regex.search(line):
+                self.record(event_name)
+                return
+        if LOG_LINE_PROBLEM_REGEX.search(line):
+            log_msg(f"Spotty '{self.__name}': {line}", LOGWARNING)
@@ -0,0 +1,378 @@
+import json
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Union
+
+from xbmc import LOGDEBUG, LOGWARNING
+
+from utils import bytes_to_megabytes, log_msg, log_exception
+
+SPOOL_INDEX_FILENAME = "index.json"
+SPOOL_FILE_EXT = ".wav"
+# Tracks being decoded. Each buffer has its own, so a late discard can't hit a newer one.
+PART_FILE_EXT = ".part"
+SEEK_FILE_EXT = ".seek"
+# Memory-backed, where there is one, for decodes that won't be spooled anyway.
+SCRATCH_ROOT_DIR = "/dev/shm"
+MEMINFO_PATH = "/proc/meminfo"
+# Free memory a scratch file must leave, so decoding doesn't starve Kodi itself.
+SCRATCH_MIN_FREE_BYTES = 64 * 1024 * 1024
+
+
+def get_scratch_dir(name: str) -> str:
+    """A directory in memory for decodes that are never kept, or "" if there is none."""
+    if not os.path.isdir(SCRATCH_ROOT_DIR) or not os.access(SCRATCH_ROOT_DIR, os.W_OK):
+        return ""
+    return os.path.join(SCRATCH_ROOT_DIR, name)
+
+
+def get_spool_key(track_id: str, use_normalization: bool) -> str:
+    return f"{track_id}-{'norm' if use_normalization else 'raw'}"
+
+
+class SpoolFile:
+    """A spool file being written by a producer. Only becomes a cached entry once committed."""
+
+    def __init__(self, key: str, path: str):
+        self.key = key
+        self.path = path
+
+
+class SpooledTrack:
+    """A completely decoded track in the spool, read through 'mmap'."""
+
+    def __init__(self, track_id: str, path: str):
+        self.__track_id = track_id
+        self.__lock = threading.Lock()
+        # Kept open for 'os.sendfile', which copies from the file rather than the mapping.
+        self.__file = open(path, "rb", buffering=0)
+        try:
+            self.__data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self.__file.close()
+            raise
+        self.__length = len(self.__data)
+        self.__terminated = False
+
+    @property
+    def track_id(self) -> str:
+        return self.__track_id
+
+    @property
+    def track_length(self) -> int:
+        return self.__length
+
+    @staticmethod
+    def is_started() -> bool:
+        return True
+
+    def is_terminated(self) -> bool:
+        return self.__terminated
+
+    def terminate(self) -> None:
+        with self.__lock:
+            if self.__terminated:
+                return
+            self.__terminated = True
+            self.__data.close()
+            self.__file.close()
+
+    def get_bytes_buffered(self) -> int:
+        return self.track_length
+
+    # Fully decoded, so there is no producer for readers to hold back.
+    @staticmethod
+    def get_overrun_count() -> int:
+        return 0
+
+    @staticmethod
+    def get_stall_count() -> int:
+        return 0
+
+    @staticmethod
+    def get_resume_count() -> int:
+        return 0
+
+    def set_reader_offset(self, reader_id: int, offset: int) -> None:
+        pass
+
+    def remove_reader(self, reader_id: int) -> None:
+        pass
+
+    def wake_readers(self) -> None:
+        pass
+
+    def wait_readable(
+        self, offset: int, max_len: int, cancelled: Union[threading.Event, None] = None
+    ) -> int:
+        with self.__lock:
+            if self.__terminated:
+                return 0
+            return max(0, min(max_len, self.__length - offset))
+
+    @staticmethod
+    def get_file_position(offset: int) -> int:
+        return offset
+
+    def duplicate_file_descriptor(self) -> int:
+        with self.__lock:
+            if self.__terminated:
+                return -1
+            return os.dup(self.__file.fileno())
+
+    def read(self, offset: int, max_len: int) -> bytes:
+        with self.__lock:
+            if self.__terminated:
+                return bytes()
+            return self.__data[offset : offset + max_len]
+
+
+class SpottyPcmSpool:
+    """Byte-budgeted on-disk cache of decoded wav streams, keyed by track id and
+    normalization flag, with least recently used entries evicted first. Decodes that won't
+    be kept go to a scratch directory instead, ideally in memory, as far as its own budget
+    allows."""
+
+    def __init__(
+        self, spool_dir: str, max_bytes: int, scratch_dir: str = "", max_scratch_bytes: int = 0
+    ):
+        self.__spool_dir = spool_dir
+        self.__max_bytes = max_bytes
+        # Where tracks that won't fit the budget, and seeks, are decoded. Writing those to
+        # disk only to delete them again would wear out SD cards for nothing. Each is held
+        # whole, so the scratch has a budget of its own, and anything over it goes to disk.
+        self.__scratch_dir = scratch_dir or spool_dir
+        self.__max_scratch_bytes = max_scratch_bytes
+        # Scratch file path -> bytes reserved for it.
+        self.__scratch_files: Dict[str, int] = dict()
+        self.__lock = threading.Lock()
+
+        # Spool key -> size in bytes, least recently used first.
+        self.__entries: OrderedDict[str, int] = OrderedDict()
+        self.__total_bytes = 0
+        # Replays only reorder the entries, which is saved with the next change, or on 'close'.
+        # Writing the index on every one would mean a synchronous write per seek.
+        self.__is_order_changed = False
+
+        os.makedirs(self.__spool_dir, exist_ok=True)
+        if self.__scratch_dir != self.__spool_dir:
+            try:
+                os.makedirs(self.__scratch_dir, exist_ok=True)
+            except OSError as exc:
+                log_msg(f"Could not create '{self.__scratch_dir}': {exc}", LOGWARNING)
+                self.__scratch_dir = self.__spool_dir
+        self.__load_index()
+        with self.__lock:
+            self.__evict()
+
+    def set_max_bytes(self, max_bytes: int) -> None:
+        with self.__lock:
+            if max_bytes == self.__max_bytes:
+                return
+            self.__max_bytes = max_bytes
+            self.__evict()
+
+    def set_max_scratch_bytes(self, max_scratch_bytes: int) -> None:
+        """Only applies to new scratch files."""
+        with self.__lock:
+            self.__max_scratch_bytes = max_scratch_bytes
+
+    def close(self) -> None:
+        """Saves the order of replayed entries."""
+        with self.__lock:
+            if self.__is_order_changed:
+                self.__save_index()
+
+    def would_keep(self, size: int) -> bool:
+        """Whether a completed track of 'size' bytes would be spooled rather than deleted."""
+        with self.__lock:
+            return size <= self.__max_bytes
+
+    def contains(self, track_id: str, use_normalization: bool) -> bool:
+        with self.__lock:
+            return get_spool_key(track_id, use_normalization) in self.__entries
+
+    def open_track(self, track_id: str, use_normalization: bool) -> Union[SpooledTrack, None]:
+        key = get_spool_key(track_id, use_normalization)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+            self.__is_order_changed = True
+
+        try:
+            spooled_track = SpooledTrack(track_id, self.__get_path(key))
+            log_msg(f"Serving track '{track_id}' from the spool ('{key}').", LOGDEBUG)
+            return spooled_track
+        except Exception as exc:
+            log_exception(exc, f"Could not open spooled track '{key}'")
+            with self.__lock:
+                self.__remove_entry(key)
+                self.__save_index()
+            return None
+
+    def create_spool_file(self, track_id: str, use_normalization: bool, size: int) -> SpoolFile:
+        """A file for decoding a whole track of 'size' bytes, to be committed or discarded."""
+        key = get_spool_key(track_id, use_normalization)
+        with self.__lock:
+            # Any previous entry for this key is being decoded again.
+            self.__remove_entry(key)
+            self.__save_index()
+            if size <= self.__max_bytes:
+                return SpoolFile(key, self.__make_temp_path(self.__spool_dir, key, PART_FILE_EXT))
+            return SpoolFile(key, self.__make_scratch_path(key, PART_FILE_EXT, size))
+
+    def create_seek_file(self, track_id: str, use_normalization: bool, size: int) -> SpoolFile:
+        """A scratch file for decoding the last 'size' bytes of a track. These never become
+        cached entries."""
+        key = get_spool_key(track_id, use_normalization)
+        with self.__lock:
+            return SpoolFile(key, self.__make_scratch_path(key, SEEK_FILE_EXT, size))
+
+    def commit(self, spool_file: SpoolFile) -> None:
+        size = os.path.getsize(spool_file.path)
+        with self.__lock:
+            self.__scratch_files.pop(spool_file.path, None)
+            if size > self.__max_bytes:
+                self.__delete_path(spool_file.path)
+                return
+            try:
+                os.replace(spool_file.path, self.__get_path(spool_file.key))
+            except OSError as exc:
+                # On Windows, a file still open by a reader cannot be renamed. Nor can a
+                # scratch file, if the budget was raised while it was being decoded.
+                log_msg(f"Could not spool '{spool_file.key}': {exc}", LOGWARNING)
+                self.__delete_path(spool_file.path)
+                return
+            # Replaced, if the track was spooled again meanwhile.
+            self.__total_bytes -= self.__entries.pop(spool_file.key, 0)
+            self.__entries[spool_file.key] = size
+            self.__total_bytes += size
+            self.__evict()
+        log_msg(
+            f"Spooled '{spool_file.key}'. Spool size is now"
+            f" {bytes_to_megabytes(self.__total_bytes):.1f}MB.",
+            LOGDEBUG,
+        )
+
+    def discard(self, spool_file: SpoolFile) -> None:
+        # Only ever a buffer's own temp file, never a committed entry.
+        self.__delete_path(spool_file.path)
+        with self.__lock:
+            self.__scratch_files.pop(spool_file.path, None)
+
+    def __evict(self) -> None:
+        for key in list(self.__entries.keys()):
+            if self.__total_bytes <= self.__max_bytes:
+                break
+            log_msg(f"Evicting '{key}' from the spool.", LOGDEBUG)
+            self.__remove_entry(key)
+        self.__save_index()
+
+    def __remove_entry(self, key: str) -> None:
+        size = self.__entries.pop(key, None)
+        if size is None:
+            return
+        self.__total_bytes -= size
+        self.__delete_file(key)
+
+    def __delete_file(self, key: str) -> None:
+        self.__delete_path(self.__get_path(key))
+
+    @staticmethod
+    def __delete_path(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            # On Windows, a file still open by a reader cannot be removed.
+            log_msg(f"Could not remove spool file '{path}': {exc}", LOGWARNING)
+
+    def __make_scratch_path(self, key: str, ext: str, size: int) -> str:
+        """In the scratch directory if 'size' fits its budget and free space, else in the
+        spool directory."""
+        if self.__scratch_dir == self.__spool_dir:
+            return self.__make_temp_path(self.__spool_dir, key, ext)
+        if sum(self.__scratch_files.values()) + size > self.__max_scratch_bytes or (
+            self.__get_free_memory(self.__scratch_dir) < size + SCRATCH_MIN_FREE_BYTES
+        ):
+            log_msg(f"No room in memory to decode '{key}'. Decoding to disk.", LOGDEBUG)
+            return self.__make_temp_path(self.__spool_dir, key, ext)
+        path = self.__make_temp_path(self.__scratch_dir, key, ext)
+        self.__scratch_files[path] = size
+        return path
+
+    @staticmethod
+    def __get_free_memory(scratch_dir: str) -> int:
+        """The smaller of the room left in the scratch file system and the memory available.
+        A tmpfs may be sized far beyond what is actually free."""
+        try:
+            stats = os.statvfs(scratch_dir)
+            with open(MEMINFO_PATH, "r") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        available = int(line.split()[1]) * 1024
+                        return min(available, stats.f_bavail * stats.f_frsize)
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    @staticmethod
+    def __make_temp_path(temp_dir: str, key: str, ext: str) -> str:
+        fd, path = tempfile.mkstemp(suffix=ext, prefix=key + "-", dir=temp_dir)
+        os.close(fd)
+        return path
+
+    def __get_path(self, key: str) -> str:
+        return os.path.join(self.__spool_dir, key + SPOOL_FILE_EXT)
+
+    def __get_index_path(self) -> str:
+        return os.path.join(self.__spool_dir, SPOOL_INDEX_FILENAME)
+
+    def __load_index(self) -> None:
+        index_path = self.__get_index_path()
+        try:
+            if os.path.exists(index_path):
+                with open(index_path, "r") as f:
+                    for key, size in json.load(f):
+                        if os.path.exists(self.__get_path(key)):
+                            self.__entries[key] = size
+                            self.__total_bytes += size
+        except Exception as exc:
+            log_exception(exc, f"Could not load spool index '{index_path}'")
+            self.__entries.clear()
+            self.__total_bytes = 0
+
+        # Anything not in the index was never committed, so remove it.
+        for filename in os.listdir(self.__spool_dir):
+            key, ext = os.path.splitext(filename)
+            if (ext == SPOOL_FILE_EXT and key not in self.__entries) or ext in (
+                SEEK_FILE_EXT,
+                PART_FILE_EXT,
+            ):
+                self.__delete_path(os.path.join(self.__spool_dir, filename))
+        if self.__scratch_dir != self.__spool_dir:
+            for filename in os.listdir(self.__scratch_dir):
+                if os.path.splitext(filename)[1] in (SEEK_FILE_EXT, PART_FILE_EXT):
+                    self.__delete_path(os.path.join(self.__scratch_dir, filename))
+
+        log_msg(
+            f"Loaded spool index with {len(self.__entries)} entries,"
+            f" {bytes_to_megabytes(self.__total_bytes):.1f}MB.",
+            LOGDEBUG,
+        )
+
+    def __save_index(self) -> None:
+        index_path = self.__get_index_path()
+        temp_path = index_path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(list(self.__entries.items()), f)
+            os.replace(temp_path, index_path)
+            self.__is_order_changed = False
+        except Exception as exc:
+            log_exception(exc, f"Could not save spool index '{index_path}'")
@@ -0,0 +1,135 @@
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+from xbmc import LOGDEBUG, LOGWARNING
+
+from utils import log_msg, log_exception
+
+MAX_SPOTTY_PROCESSES = 16
+REAP_INTERVAL_IN_SECS = 0.5
+STOP_DEADLINE_IN_SECS = 3.0
+# A supervised spotty restarts after this, doubling up to the max while it keeps failing.
+RESTART_MIN_WAIT_IN_SECS = 1
+RESTART_MAX_WAIT_IN_SECS = 300
+# A supervised spotty that ran at least this long was fine. Restart it after the min wait.
+RESTART_STABLE_RUN_IN_SECS = 60
+
+
+class SpottyProcessManager:
+    """Owns every spotty child process. It caps how many can run, reaps them as soon as
+    they exit, keeps supervised ones (e.g. Spotify Connect) running, and stops them all
+    together on shutdown."""
+
+    def __init__(self, max_processes: int = MAX_SPOTTY_PROCESSES):
+        self.__max_processes = max_processes
+        self.__processes_changed = threading.Condition()
+        # Pid -> (process, name).
+        self.__processes: Dict[int, Tuple[subprocess.Popen, str]] = dict()
+        # Processes being started, counted against the max.
+        self.__starting_count = 0
+        self.__stopped = threading.Event()
+        self.__reaper_thread = threading.Thread(target=self.__reap, daemon=True)
+        self.__reaper_thread.start()
+
+    def get_process_count(self) -> int:
+        with self.__processes_changed:
+            return len(self.__processes)
+
+    def spawn(self, name: str, start: Callable[[], subprocess.Popen]) -> subprocess.Popen:
+        """Run 'start' if there is room for another spotty, and take ownership of the
+        process it returns."""
+        with self.__processes_changed:
+            if self.__stopped.is_set():
+                raise Exception(f"Cannot start spotty '{name}' while shutting down.")
+            if len(self.__processes) + self.__starting_count >= self.__max_processes:
+                raise Exception(
+                    f"Cannot start spotty '{name}':"
+                    f" already at the max of {self.__max_processes} spotty processes."
+                )
+            self.__starting_count += 1
+
+        process = None
+        try:
+            process = start()
+            return process
+        finally:
+            with self.__processes_changed:
+                self.__starting_count -= 1
+                if process:
+                    self.__processes[process.pid] = (process, name)
+                    self.__processes_changed.notify_all()
+
+    def supervise(self, name: str, run: Callable[[], subprocess.Popen]) -> None:
+        """Keep a spotty started by 'run' going until 'stop_all', restarting it with
+        backoff whenever it exits."""
+        threading.Thread(target=self.__supervise, args=(name, run), daemon=True).start()
+
+    def stop_all(self, deadline_in_secs: float = STOP_DEADLINE_IN_SECS) -> None:
+        """Terminate all spotty processes at once, then kill any still running at the
+        deadline."""
+        self.__stopped.set()
+        with self.__processes_changed:
+            processes = list(self.__processes.values())
+            self.__processes_changed.notify_all()
+        if not processes:
+            return
+
+        log_msg(f"Stopping {len(processes)} spotty processes.", LOGDEBUG)
+        for process, _ in processes:
+            if process.poll() is None:
+                process.terminate()
+
+        deadline = time.monotonic() + deadline_in_secs
+        for process, name in processes:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                log_msg(f"Killing spotty '{name}' ({process.pid}).", LOGWARNING)
+                process.kill()
+
+        with self.__processes_changed:
+            for process, _ in processes:
+                self.__remove_if_exited(process)
+
+    def __reap(self) -> None:
+        while True:
+            with self.__processes_changed:
+                self.__processes_changed.wait_for(lambda: self.__processes)
+                for process, _ in list(self.__processes.values()):
+                    self.__remove_if_exited(process)
+                self.__processes_changed.wait(REAP_INTERVAL_IN_SECS)
+
+    def __remove_if_exited(self, process: subprocess.Popen) -> None:
+        # Polling an exited child also reaps it, so it doesn't linger as a zombie.
+        if process.poll() is None:
+            return
+        _, name = self.__processes.pop(process.pid, (None, ""))
+        if name:
+            log_msg(
+                f"Spotty '{name}' ({process.pid}) exited with code {process.returncode}."
+                f" {len(self.__processes)} spotty processes left.",
+                LOGDEBUG,
+            )
+
+    def __supervise(self, name: str, run: Callable[[], subprocess.Popen]) -> None:
+        restart_wait_in_secs = RESTART_MIN_WAIT_IN_SECS
+        while not self.__stopped.is_set():
+            start_time = time.monotonic()
+            try:
+                process = run()
+                process.wait()
+            except Exception as exc:
+                log_exception(exc, f"Error running supervised spotty '{name}'")
+            if self.__stopped.is_set():
+                return
+
+            if time.monotonic() - start_time >= RESTART_STABLE_RUN_IN_SECS:
+                restart_wait_in_secs = RESTART_MIN_WAIT_IN_SECS
+            log_msg(
+                f"Supervised spotty '{name}' stopped. Restarting in {restart_wait_in_secs}s.",
+                LOGWARNING,
+            )
+            self.__stopped.wait(restart_wait_in_secs)
+            restart_wait_in_secs = min(2 * restart_wait_in_secs, RESTART_MAX_WAIT_IN_SECS)
@@ -0,0 +1,235 @@
+import errno
+import os
+import selectors
+import socket
+import threading
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from xbmc import LOGDEBUG, LOGWARNING
+
+from spotty_pcm_spool import SpooledTrack
+from spotty_track_buffer import SpottyTrackBuffer
+from utils import log_msg, log_exception
+
+# Errors meaning 'os.sendfile' can't copy from this file to this socket.
+SENDFILE_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK)
+
+UNWATCH_TIMEOUT_IN_SECS = 1.0
+
+# A part of the stream that has been buffered: (buffer, track offset, length).
+StreamRegion = Tuple[Union[SpottyTrackBuffer, SpooledTrack], int, int]
+
+__sendfile_supported = hasattr(os, "sendfile")
+
+
+def is_sendfile_supported() -> bool:
+    return __sendfile_supported
+
+
+def disable_sendfile() -> None:
+    global __sendfile_supported
+    __sendfile_supported = False
+
+
+class ClientDisconnectWatcher:
+    """Watches the sockets of streams waiting for audio, and cancels a stream as soon as
+    its client hangs up, instead of when the next chunk fails to send."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Socket changes for the watcher thread: (socket, on disconnect or None to unwatch,
+        # set once applied).
+        self.__changes: List[
+            Tuple[socket.socket, Union[Callable[[], None], None], threading.Event]
+        ] = []
+        self.__wake_reader, self.__wake_writer = socket.socketpair()
+        self.__wake_reader.setblocking(False)
+        self.__thread: Union[threading.Thread, None] = None
+
+    def watch(self, sock: socket.socket, on_disconnect: Callable[[], None]) -> None:
+        self.__change(sock, on_disconnect)
+
+    def unwatch(self, sock: socket.socket) -> None:
+        """Returns once the socket is no longer watched, so it can be closed safely."""
+        self.__change(sock, None).wait(UNWATCH_TIMEOUT_IN_SECS)
+
+    def __change(
+        self, sock: socket.socket, on_disconnect: Union[Callable[[], None], None]
+    ) -> threading.Event:
+        applied = threading.Event()
+        with self.__lock:
+            self.__changes.append((sock, on_disconnect, applied))
+            if not self.__thread:
+                self.__thread = threading.Thread(target=self.__watch, daemon=True)
+                self.__thread.start()
+        self.__wake_writer.send(b"\0")
+        return applied
+
+    def __watch(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.__wake_reader, selectors.EVENT_READ)
+        while True:
+            try:
+                for key, _ in selector.select():
+                    if key.fileobj is self.__wake_reader:
+                        self.__apply_changes(selector)
+                    elif self.__has_hung_up(key.fileobj):
+                        selector.unregister(key.fileobj)
+                        log_msg("Stream client hung up.", LOGDEBUG)
+                        key.data()
+                    else:
+                        # Not a hang-up, so the client sent something. Stop watching it, or
+                        # the socket would stay readable.
+                        selector.unregister(key.fileobj)
+            except Exception as exc:
+                log_exception(exc, "Error watching stream clients")
+
+    def __apply_changes(self, selector: selectors.BaseSelector) -> None:
+        try:
+            while self.__wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self.__lock:
+            changes, self.__changes = self.__changes, []
+        for sock, on_disconnect, applied in changes:
+            if self.__is_registered(selector, sock):
+                selector.unregister(sock)
+            if on_disconnect and sock.fileno() >= 0:
+                selector.register(sock, selectors.EVENT_READ, on_disconnect)
+            applied.set()
+
+    @staticmethod
+    def __is_registered(selector: selectors.BaseSelector, sock: socket.socket) -> bool:
+        try:
+            selector.get_key(sock)
+            return True
+        except (KeyError, ValueError):
+            return False
+
+    @staticmethod
+    def __has_hung_up(sock: socket.socket) -> bool:
+        try:
+            # Readable, so this doesn't block. An orderly hang-up reads as empty.
+            return not sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+
+__disconnect_watcher = ClientDisconnectWatcher()
+
+
+def get_disconnect_watcher() -> ClientDisconnectWatcher:
+    return __disconnect_watcher
+
+
+class SpottyRangeStream:
+    """File-like view of a session's byte range, returned to bottle as a response body.
+    A server that knows about 'send_to_socket' has the kernel copy the audio straight from
+    the track buffer's spool file to the client. Any other server just calls 'read'."""
+
+    def __init__(
+        self,
+        regions: Iterator[StreamRegion],
+        cancel: Callable[[], None],
+        on_close: Callable[[], None],
+    ):
+        self.__regions = regions
+        self.__region: Union[StreamRegion, None] = None
+        # Stops the stream waiting for audio, e.g. once the client has gone.
+        self.__cancel = cancel
+        # Must be safe to call twice: a started generator already cleaned up when closed.
+        self.__on_close = on_close
+
+    def read(self, size: int = -1) -> bytes:
+        region = self.__next_region()
+        if not region:
+            return bytes()
+        track_buffer, offset, length = region
+        if 0 <= size < length:
+            length = size
+        data = track_buffer.read(offset, length)
+        self.__consume(len(data))
+        return data
+
+    def send_to_socket(self, sock: socket.socket) -> int:
+        """Send the rest of the range to 'sock' and return the number of bytes sent."""
+        bytes_sent = 0
+        file_descriptors: Dict[int, int] = {}
+        get_disconnect_watcher().watch(sock, self.__cancel)
+        try:
+            while True:
+                region = self.__next_region()
+                if not region:
+                    return bytes_sent
+                track_buffer, offset, length = region
+                if is_sendfile_supported():
+                    sent = self.__sendfile(sock, file_descriptors, track_buffer, offset, length)
+                else:
+                    sent = 0
+                if not sent:
+                    data = track_buffer.read(offset, length)
+                    if not data:
+                        return bytes_sent
+                    sock.sendall(data)
+                    sent = len(data)
+                self.__consume(sent)
+                bytes_sent += sent
+        finally:
+            get_disconnect_watcher().unwatch(sock)
+            for file_descriptor in file_descriptors.values():
+                os.close(file_descriptor)
+
+    def cancel(self) -> None:
+        """For servers that watch for the client going themselves."""
+        self.__cancel()
+
+    def close(self) -> None:
+        try:
+            self.__regions.close()
+        finally:
+            # Closing a generator that never started doesn't run its 'finally', e.g. when
+            # the client went before the headers were sent, or for a HEAD request.
+            self.__on_close()
+
+    def __next_region(self) -> Union[StreamRegion, None]:
+        if not self.__region:
+            self.__region = next(self.__regions, None)
+        return self.__region
+
+    def __consume(self, length: int) -> None:
+        track_buffer, offset, region_length = self.__region
+        if length < region_length:
+            self.__region = (track_buffer, offset + length, region_length - length)
+        else:
+            self.__region = None
+
+    @staticmethod
+    def __sendfile(
+        sock: socket.socket,
+        file_descriptors: Dict[int, int],
+        track_buffer: Union[SpottyTrackBuffer, SpooledTrack],
+        offset: int,
+        length: int,
+    ) -> int:
+        """Returns zero if the region could not be sent this way."""
+        file_descriptor = file_descriptors.get(id(track_buffer))
+        if file_descriptor is None:
+            file_descriptor = track_buffer.duplicate_file_descriptor()
+            if file_descriptor < 0:
+                return 0
+            file_descriptors[id(track_buffer)] = file_descriptor
+
+        try:
+            return os.sendfile(
+                sock.fileno(), file_descriptor, track_buffer.get_file_position(offset), length
+            )
+        except OSError as exc:
+            if exc.errno not in SENDFILE_UNSUPPORTED_ERRNOS:
+                raise
+            log_msg(f"Cannot use sendfile for audio streams: {exc}", LOGWARNING)
+            disable_sendfile()
+            return 0
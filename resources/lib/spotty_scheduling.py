@@ -0,0 +1,102 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import struct
+from typing import List, NamedTuple, Union
+
+from xbmc import LOGDEBUG
+
+from utils import log_msg
+
+SPOTTY_ROLE_STREAMING = "streaming"
+SPOTTY_ROLE_CONNECT = "connect"
+SPOTTY_ROLE_TOKEN = "token"
+
+# Linux I/O scheduling classes, as used by 'ionice'.
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# There's no 'os.ioprio_set', so it's called by syscall number. That depends on the ABI of
+# this process, not on the kernel's: a 32-bit userland on a 64-bit kernel, as on Raspberry
+# Pi OS and many Android boxes, reports 'aarch64' but needs the 32-bit ARM number.
+# (Architecture, process bits) -> syscall number.
+IOPRIO_SET_SYSCALLS = {
+    ("x86", 64): 251,
+    ("x86", 32): 289,
+    ("arm", 64): 30,
+    ("arm", 32): 314,
+    ("ppc", 64): 273,
+    ("ppc", 32): 273,
+}
+# Machine name prefix -> architecture.
+MACHINE_ARCHITECTURES = {
+    "x86_64": "x86",
+    "amd64": "x86",
+    "i386": "x86",
+    "i686": "x86",
+    "aarch64": "arm",
+    "arm": "arm",
+    "ppc": "ppc",
+}
+
+
+class SpottySchedulingPolicy(NamedTuple):
+    nice: int
+    io_class: int
+    # 0 (highest) to 7 (lowest) within the best effort class.
+    io_level: int
+
+
+# Decoders feed what is playing now. So does the Connect daemon, which plays audio itself
+# when Kodi is the Spotify Connect device, so it gets the same priorities. These are just
+# the defaults for a new process, so for those roles only 'spotty_cpus' changes anything.
+# Token logins only run in the background and must not take CPU or disk time from them or
+# Kodi's GUI.
+SPOTTY_SCHEDULING_POLICIES = {
+    SPOTTY_ROLE_STREAMING: SpottySchedulingPolicy(0, IOPRIO_CLASS_BE, 4),
+    SPOTTY_ROLE_CONNECT: SpottySchedulingPolicy(0, IOPRIO_CLASS_BE, 4),
+    SPOTTY_ROLE_TOKEN: SpottySchedulingPolicy(5, IOPRIO_CLASS_BE, 7),
+}
+
+__libc = None
+
+
+def apply_scheduling_policy(pid: int, role: str, cpus: List[int]) -> None:
+    """Set a started spotty's priorities for its role, and pin it to 'cpus' if not empty.
+    Whatever the platform doesn't support is left as is."""
+    policy = SPOTTY_SCHEDULING_POLICIES[role]
+    try:
+        if policy.nice and hasattr(os, "setpriority"):
+            os.setpriority(os.PRIO_PROCESS, pid, policy.nice)
+        __set_io_priority(pid, policy)
+        if cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, cpus)
+    except OSError as exc:
+        log_msg(f"Could not apply '{role}' scheduling policy to spotty {pid}: {exc}", LOGDEBUG)
+
+
+def __get_ioprio_set_syscall() -> Union[int, None]:
+    machine = platform.machine().lower()
+    architecture = next(
+        (arch for prefix, arch in MACHINE_ARCHITECTURES.items() if machine.startswith(prefix)),
+        None,
+    )
+    process_bits = 8 * struct.calcsize("P")
+    return IOPRIO_SET_SYSCALLS.get((architecture, process_bits))
+
+
+def __set_io_priority(pid: int, policy: SpottySchedulingPolicy) -> None:
+    if platform.system() != "Linux":
+        return
+    syscall_number = __get_ioprio_set_syscall()
+    if syscall_number is None:
+        return
+
+    global __libc
+    if __libc is None:
+        __libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    io_priority = (policy.io_class << IOPRIO_CLASS_SHIFT) | policy.io_level
+    if __libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, pid, io_priority) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Union
+
+from xbmc import LOGDEBUG, LOGWARNING
+
+from utils import log_msg, log_exception
+
+# Renew this long before the token expires, less up to the jitter, so a slow or failing
+# renewal still has time to be retried before anyone sees an expired token.
+RENEW_BEFORE_EXPIRY_IN_SECS = 600
+RENEW_JITTER_IN_SECS = 60
+RETRY_MIN_WAIT_IN_SECS = 1
+RETRY_MAX_WAIT_IN_SECS = 60
+
+
+class SpottyTokenBroker:
+    """Keeps a fresh Spotify token on a thread of its own. Callers read the latest published
+    token and never wait for a spotty process. Renewals happen one at a time, and
+    everybody asking for one while it runs gets the result of that same renewal."""
+
+    def __init__(
+        self,
+        get_token: Callable[[], Union[Dict[str, str], None]],
+        on_token: Callable[[Dict[str, str]], None],
+    ):
+        self.__get_token = get_token
+        self.__on_token = on_token
+
+        self.__token_changed = threading.Condition()
+        self.__token: Union[Dict[str, str], None] = None
+        # Counts finished renewal attempts, so waiters can tell when 'their' one is done.
+        self.__renewal_count = 0
+        self.__renewal_wanted = threading.Event()
+        # Only stopping ends a retry wait early. Asking for a renewal doesn't, or callers
+        # would start a new login on each request while Spotify is failing.
+        self.__stop_requested = threading.Event()
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    def stop(self) -> None:
+        with self.__token_changed:
+            self.__stopped = True
+            self.__token_changed.notify_all()
+        self.__stop_requested.set()
+        self.__renewal_wanted.set()
+        self.__thread.join(5)
+
+    def get_token(self) -> Union[Dict[str, str], None]:
+        """The latest token, or None if there has never been one."""
+        with self.__token_changed:
+            return self.__token
+
+    def wait_for_token(self, timeout_in_secs: float) -> Union[Dict[str, str], None]:
+        """The latest unexpired token, waiting up to 'timeout_in_secs' for one to be
+        published."""
+        with self.__token_changed:
+            if self.__token and not self.__is_valid(self.__token):
+                # The scheduled renewal didn't happen in time, e.g. over a suspend. Renew now,
+                # sharing the renewal with everyone else waiting.
+                self.__renewal_wanted.set()
+            self.__token_changed.wait_for(
+                lambda: self.__stopped or self.__is_valid(self.__token), timeout_in_secs
+            )
+            return self.__token if self.__is_valid(self.__token) else None
+
+    def renew(self, timeout_in_secs: float) -> Union[Dict[str, str], None]:
+        """Ask for a renewal now, e.g. after a token was rejected, and wait for it. Joins the
+        renewal in flight if there is one. After a failed renewal, the next one still waits
+        for its retry time."""
+        with self.__token_changed:
+            wanted_count = self.__renewal_count + 1
+            self.__renewal_wanted.set()
+            self.__token_changed.wait_for(
+                lambda: self.__stopped or self.__renewal_count >= wanted_count, timeout_in_secs
+            )
+            return self.__token
+
+    def __run(self) -> None:
+        retry_wait_in_secs = RETRY_MIN_WAIT_IN_SECS
+        while not self.__stopped:
+            if not self.__renewal_wanted.is_set() and not self.__is_renewal_due():
+                self.__renewal_wanted.wait(self.__get_secs_until_renewal())
+                continue
+            self.__renewal_wanted.clear()
+
+            if self.__renew_once():
+                retry_wait_in_secs = RETRY_MIN_WAIT_IN_SECS
+                continue
+
+            # Full jitter, so a failing Spotify login isn't hammered at a fixed rate.
+            wait_in_secs = random.uniform(RETRY_MIN_WAIT_IN_SECS, retry_wait_in_secs)
+            log_msg(f"Could not renew Spotify token. Retrying in {wait_in_secs:.1f}s.", LOGWARNING)
+            self.__stop_requested.wait(wait_in_secs)
+            retry_wait_in_secs = min(2 * retry_wait_in_secs, RETRY_MAX_WAIT_IN_SECS)
+
+    def __renew_once(self) -> bool:
+        log_msg("Renewing Spotify token.", LOGDEBUG)
+        token = None
+        try:
+            token = self.__get_token()
+        except Exception as exc:
+            log_exception(exc, "Error renewing Spotify token")
+
+        with self.__token_changed:
+            if token:
+                # Jitter the renewal time once per token, not on every check.
+                token = dict(token)
+                token["renew_at"] = (
+                    int(token["expires_at"])
+                    - RENEW_BEFORE_EXPIRY_IN_SECS
+                    - random.uniform(0, RENEW_JITTER_IN_SECS)
+                )
+                self.__token = token
+            # Whoever asked while this renewal ran gets its result, not another renewal.
+            self.__renewal_wanted.clear()
+            self.__renewal_count += 1
+            self.__token_changed.notify_all()
+
+        if not token:
+            return False
+        log_msg(
+            f"Renewed Spotify token. Expires at"
+            f" {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(token['expires_at'])))}.",
+            LOGDEBUG,
+        )
+        try:
+            self.__on_token(token)
+        except Exception as exc:
+            log_exception(exc, "Error publishing Spotify token")
+        return True
+
+    def __is_renewal_due(self) -> bool:
+        return self.__get_secs_until_renewal() <= 0
+
+    def __get_secs_until_renewal(self) -> float:
+        token = self.get_token()
+        if not token:
+            return 0
+        return token["renew_at"] - time.time()
+
+    @staticmethod
+    def __is_valid(token: Union[Dict[str, str], None]) -> bool:
+        return bool(token) and int(token["expires_at"]) > time.time()
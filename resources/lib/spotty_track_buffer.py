@@ -0,0 +1,448 @@
+import errno
+import os
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Tuple, Union
+
+from xbmc import LOGDEBUG, LOGERROR, LOGWARNING
+
+from spotty_log_watcher import FIRST_AUDIO_EVENT
+from spotty_pcm_spool import SpoolFile
+from utils import kill_process_by_pid, log_msg, log_exception
+
+SPOTTY_READ_CHUNK_SIZE = 524288
+READER_WAIT_TIMEOUT_IN_SECS = 1.0
+# Spotty output can come up a little short of the wav header's duration. Allow up to
+# two seconds of 44.1kHz, 16 bit stereo PCM before treating the track as incomplete.
+COMPLETE_TRACK_TOLERANCE_IN_BYTES = 2 * 44100 * 4
+STALL_CHECK_INTERVAL_IN_SECS = 1.0
+# Resumes per buffer, so a track spotty can't decode doesn't restart it forever.
+MAX_DECODER_RESUMES = 3
+
+# Errors meaning 'os.splice' can't be used between these two files, e.g. on filesystems
+# without splice support.
+SPLICE_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV)
+
+__splice_supported = hasattr(os, "splice")
+__chunk_pool: List[bytearray] = []
+__chunk_pool_lock = threading.Lock()
+
+
+def is_splice_supported() -> bool:
+    return __splice_supported
+
+
+def disable_splice() -> None:
+    global __splice_supported
+    __splice_supported = False
+
+
+def take_chunk_buffer() -> bytearray:
+    """A read buffer from the pool, so producers don't allocate a new chunk per read."""
+    with __chunk_pool_lock:
+        if __chunk_pool:
+            return __chunk_pool.pop()
+    return bytearray(SPOTTY_READ_CHUNK_SIZE)
+
+
+def give_back_chunk_buffer(chunk_buffer: bytearray) -> None:
+    with __chunk_pool_lock:
+        __chunk_pool.append(chunk_buffer)
+
+
+class SpottyTrackBuffer:
+    """Growing copy of a track's wav stream in a spool file, fed by a single spotty process."""
+
+    def __init__(
+        self,
+        track_id: str,
+        wav_header: bytes,
+        track_length: int,
+        spool_file: SpoolFile,
+        on_complete: Callable[[SpoolFile], None],
+        on_discard: Callable[[SpoolFile], None],
+        byte_limit: int = 0,
+        start_offset: int = 0,
+        on_finished: Callable[[], None] = lambda: None,
+        read_ahead_limit: int = 0,
+        resume_spotty: Union[Callable[[int], Tuple[subprocess.Popen, int]], None] = None,
+        stall_timeout_in_secs: float = 0,
+    ):
+        self.__track_id = track_id
+        self.__track_length = track_length
+        # The track offset of the first byte in the spool file. Non-zero for seek buffers.
+        self.__start_offset = start_offset
+        # When non-zero, the producer pauses once this many bytes are buffered.
+        self.__byte_limit = byte_limit
+        # When non-zero, the producer pauses once this many bytes ahead of the slowest reader.
+        self.__read_ahead_limit = read_ahead_limit
+        # Reader id -> track offset the reader has got to.
+        self.__reader_offsets: Dict[int, int] = dict()
+        # Times the producer had to pause for the slowest reader.
+        self.__overrun_count = 0
+        # Starts a new spotty at a track offset when the current one stalls or ends early.
+        # Returns the process and how many bytes of its output come before that offset.
+        self.__resume_spotty = resume_spotty
+        # When non-zero, a spotty producing nothing for this long is treated as stalled.
+        self.__stall_timeout_in_secs = stall_timeout_in_secs
+        self.__last_progress_time = 0.0
+        self.__waiting_for_room = False
+        self.__stall_count = 0
+        self.__resume_count = 0
+
+        self.__spool_file = spool_file
+        self.__on_complete = on_complete
+        self.__on_discard = on_discard
+        # Called once the producer has stopped for good, or on terminating an unstarted buffer.
+        self.__on_finished = on_finished
+        self.__writer = open(spool_file.path, "wb", buffering=0)
+        self.__writer.write(wav_header)
+        self.__reader = open(spool_file.path, "rb", buffering=0)
+        self.__reader_lock = threading.Lock()
+
+        # The track offset just past the last buffered byte.
+        self.__bytes_buffered = start_offset + len(wav_header)
+        self.__data_available = threading.Condition()
+        self.__finished = False
+        self.__terminated = False
+
+        self.__spotty_process: subprocess.Popen = None
+        self.__producer_thread: threading.Thread = None
+
+    @property
+    def track_id(self) -> str:
+        return self.__track_id
+
+    @property
+    def track_length(self) -> int:
+        return self.__track_length
+
+    def is_started(self) -> bool:
+        return self.__producer_thread is not None
+
+    def is_terminated(self) -> bool:
+        return self.__terminated
+
+    def is_producing(self) -> bool:
+        with self.__data_available:
+            return self.is_started() and not self.__finished
+
+    def get_bytes_buffered(self) -> int:
+        with self.__data_available:
+            return self.__bytes_buffered
+
+    def get_overrun_count(self) -> int:
+        with self.__data_available:
+            return self.__overrun_count
+
+    def get_stall_count(self) -> int:
+        with self.__data_available:
+            return self.__stall_count
+
+    def get_resume_count(self) -> int:
+        with self.__data_available:
+            return self.__resume_count
+
+    def set_reader_offset(self, reader_id: int, offset: int) -> None:
+        with self.__data_available:
+            self.__reader_offsets[reader_id] = offset
+            self.__data_available.notify_all()
+
+    def remove_reader(self, reader_id: int) -> None:
+        with self.__data_available:
+            self.__reader_offsets.pop(reader_id, None)
+            self.__data_available.notify_all()
+
+    def remove_byte_limit(self) -> None:
+        with self.__data_available:
+            self.__byte_limit = 0
+            self.__data_available.notify_all()
+
+    def start(self, spotty_process: subprocess.Popen) -> None:
+        self.__spotty_process = spotty_process
+        self.__last_progress_time = time.monotonic()
+        self.__producer_thread = threading.Thread(target=self.__produce, daemon=True)
+        self.__producer_thread.start()
+        if self.__stall_timeout_in_secs:
+            threading.Thread(target=self.__watch_for_stall, daemon=True).start()
+
+    def terminate(self) -> None:
+        with self.__data_available:
+            if self.__terminated:
+                return
+            self.__terminated = True
+            self.__data_available.notify_all()
+        self.__stop_spotty()
+        if not self.is_started():
+            self.__close_writer(completed=False)
+            self.__on_finished()
+        with self.__reader_lock:
+            self.__reader.close()
+
+    def wait_readable(
+        self, offset: int, max_len: int, cancelled: Union[threading.Event, None] = None
+    ) -> int:
+        """Wait for the producer to buffer data at 'offset' and return how many of the next
+        'max_len' bytes are there. Zero means there is nothing more to read, or the wait
+        was 'cancelled'."""
+        with self.__data_available:
+            while True:
+                if self.__terminated:
+                    return 0
+                if cancelled and cancelled.is_set():
+                    return 0
+                if offset < self.__start_offset:
+                    return 0
+                if offset < self.__bytes_buffered:
+                    return min(max_len, self.__bytes_buffered - offset)
+                if self.__finished:
+                    return 0
+                self.__data_available.wait(READER_WAIT_TIMEOUT_IN_SECS)
+
+    def wake_readers(self) -> None:
+        """Have waiting readers check whether they were cancelled."""
+        with self.__data_available:
+            self.__data_available.notify_all()
+
+    def get_file_position(self, offset: int) -> int:
+        return offset - self.__start_offset
+
+    def duplicate_file_descriptor(self) -> int:
+        """A new descriptor for the spool file, for copying straight from it with
+        'os.sendfile'. It stays valid after the buffer is discarded. -1 if already closed."""
+        with self.__reader_lock:
+            if self.__reader.closed:
+                return -1
+            return os.dup(self.__reader.fileno())
+
+    def read(self, offset: int, max_len: int) -> bytes:
+        """Return up to 'max_len' bytes at 'offset', waiting for the producer if need be.
+        An empty result means there is nothing more to read."""
+        max_len = self.wait_readable(offset, max_len)
+        if not max_len:
+            return bytes()
+
+        with self.__reader_lock:
+            if self.__reader.closed:
+                return bytes()
+            self.__reader.seek(offset - self.__start_offset)
+            return self.__reader.read(max_len)
+
+    def __produce(self) -> None:
+        log_msg(f"Start buffering track '{self.__track_id}'.", LOGDEBUG)
+        completed = False
+        first_frame_read = False
+        chunk_buffer = take_chunk_buffer()
+        chunk_view = memoryview(chunk_buffer)
+        try:
+            while self.__bytes_buffered < self.__track_length:
+                if not self.__wait_for_room():
+                    break
+                # Never past the end of the track, so the buffer holds exactly what the
+                # wav header promised. Spotty output beyond that is dropped.
+                max_frame_len = min(
+                    SPOTTY_READ_CHUNK_SIZE, self.__track_length - self.__bytes_buffered
+                )
+                frame_len = self.__splice_frame(max_frame_len)
+                if frame_len is None:
+                    # At most one read on the pipe, so whatever spotty has written so far
+                    # is available straight away.
+                    frame_len = self.__spotty_process.stdout.readinto1(chunk_view[:max_frame_len])
+                    if frame_len and not self.__terminated:
+                        self.__writer.write(chunk_view[:frame_len])
+                if not frame_len:
+                    if not self.__terminated and self.__resume():
+                        continue
+                    if not self.__terminated and not self.__is_complete():
+                        log_msg("Nothing read from stdout.", LOGERROR)
+                    break
+                if self.__terminated:
+                    break
+                if not first_frame_read:
+                    first_frame_read = True
+                    self.__record_first_audio()
+                with self.__data_available:
+                    self.__bytes_buffered += frame_len
+                    self.__last_progress_time = time.monotonic()
+                    self.__data_available.notify_all()
+            completed = not self.__terminated and self.__is_complete()
+            if completed:
+                self.__pad_with_silence()
+        except Exception as exc:
+            log_exception(exc, f"Error buffering track '{self.__track_id}'")
+        finally:
+            chunk_view.release()
+            give_back_chunk_buffer(chunk_buffer)
+            with self.__data_available:
+                self.__finished = True
+                self.__data_available.notify_all()
+            self.__stop_spotty()
+            # Must not stop 'on_finished' below, which gives back the decoder slot.
+            try:
+                self.__close_writer(completed)
+            except Exception as exc:
+                log_exception(exc, f"Error closing buffer of track '{self.__track_id}'")
+            log_msg(
+                f"Finished buffering track '{self.__track_id}' - {self.__bytes_buffered} bytes.",
+                LOGDEBUG,
+            )
+            self.__on_finished()
+
+    def __resume(self) -> bool:
+        """Replace a spotty that stalled or ended before the end of the track with a new one
+        carrying on from the same offset. Readers just see the audio continue."""
+        while self.__resume_spotty and self.__resume_count < MAX_DECODER_RESUMES:
+            with self.__data_available:
+                if self.__terminated or self.__is_complete():
+                    return False
+                self.__resume_count += 1
+                offset = self.__bytes_buffered
+            log_msg(
+                f"Spotty stopped producing track '{self.__track_id}' at offset {offset}."
+                f" Resuming with a new spotty (resume {self.__resume_count}).",
+                LOGWARNING,
+            )
+            self.__stop_spotty()
+
+            try:
+                spotty_process, skip_len = self.__resume_spotty(offset)
+            except Exception as exc:
+                log_exception(exc, f"Error resuming track '{self.__track_id}'")
+                return False
+            with self.__data_available:
+                self.__spotty_process = spotty_process
+                self.__last_progress_time = time.monotonic()
+                if self.__terminated:
+                    # 'terminate' may have missed the new process.
+                    break
+            if self.__skip_output(skip_len):
+                return True
+
+        self.__stop_spotty()
+        return False
+
+    def __skip_output(self, skip_len: int) -> bool:
+        """Drop the new spotty's output from before the resume offset. Reads the raw pipe, so
+        nothing is left in a read buffer that splicing would miss."""
+        stdout_fd = self.__spotty_process.stdout.fileno()
+        while skip_len > 0:
+            skipped = len(os.read(stdout_fd, min(skip_len, SPOTTY_READ_CHUNK_SIZE)))
+            if not skipped:
+                return False
+            skip_len -= skipped
+        return True
+
+    def __watch_for_stall(self) -> None:
+        while True:
+            with self.__data_available:
+                if self.__finished or self.__terminated:
+                    return
+                self.__data_available.wait(STALL_CHECK_INTERVAL_IN_SECS)
+                now = time.monotonic()
+                if self.__waiting_for_room:
+                    self.__last_progress_time = now
+                    continue
+                if now - self.__last_progress_time < self.__stall_timeout_in_secs:
+                    continue
+                stalled_process = self.__spotty_process
+                # The resumed spotty gets a full timeout of its own.
+                self.__last_progress_time = now
+                self.__stall_count += 1
+
+            log_msg(
+                f"Spotty stalled on track '{self.__track_id}':"
+                f" no audio for {self.__stall_timeout_in_secs}s.",
+                LOGWARNING,
+            )
+            # The producer then reads nothing, and resumes with a new spotty.
+            self.__stop_process(stalled_process)
+
+    def __is_complete(self) -> bool:
+        return self.__bytes_buffered >= self.__track_length - COMPLETE_TRACK_TOLERANCE_IN_BYTES
+
+    def __record_first_audio(self) -> None:
+        log_watcher = getattr(self.__spotty_process, "log_watcher", None)
+        if log_watcher:
+            log_watcher.record(FIRST_AUDIO_EVENT)
+
+    def __pad_with_silence(self) -> None:
+        """Make up for spotty output a little shorter than the track length, so readers get
+        every byte the wav header promised and the end of the stream isn't left hanging."""
+        pad_len = self.__track_length - self.__bytes_buffered
+        if pad_len <= 0:
+            return
+        log_msg(f"Padding track '{self.__track_id}' with {pad_len} bytes of silence.", LOGDEBUG)
+        # Zero samples are silence in 16 bit PCM. The shortfall is at most a couple of seconds.
+        self.__writer.write(bytes(pad_len))
+        with self.__data_available:
+            self.__bytes_buffered += pad_len
+            self.__data_available.notify_all()
+
+    def __splice_frame(self, max_frame_len: int) -> Union[int, None]:
+        """Move the next frame from spotty's pipe into the spool file inside the kernel.
+        Returns None when splicing isn't possible here, so the caller must read instead."""
+        if not is_splice_supported():
+            return None
+        try:
+            return os.splice(
+                self.__spotty_process.stdout.fileno(),
+                self.__writer.fileno(),
+                max_frame_len,
+            )
+        except OSError as exc:
+            if exc.errno not in SPLICE_UNSUPPORTED_ERRNOS:
+                raise
+            log_msg(f"Cannot splice into the spool, reading instead: {exc}", LOGWARNING)
+            disable_splice()
+            return None
+
+    def __wait_for_room(self) -> bool:
+        """Pause while at the byte limit or too far ahead of the slowest reader."""
+        with self.__data_available:
+            overrun = False
+            self.__waiting_for_room = True
+            while not self.__terminated:
+                if self.__byte_limit and (
+                    self.__bytes_buffered - self.__start_offset >= self.__byte_limit
+                ):
+                    self.__data_available.wait()
+                elif self.__is_too_far_ahead():
+                    if not overrun:
+                        overrun = True
+                        self.__overrun_count += 1
+                    self.__data_available.wait()
+                else:
+                    self.__waiting_for_room = False
+                    self.__last_progress_time = time.monotonic()
+                    return True
+            return False
+
+    def __is_too_far_ahead(self) -> bool:
+        if not self.__read_ahead_limit or not self.__reader_offsets:
+            return False
+        slowest_offset = min(self.__reader_offsets.values())
+        return self.__bytes_buffered - slowest_offset >= self.__read_ahead_limit
+
+    def __close_writer(self, completed: bool) -> None:
+        self.__writer.close()
+        if completed:
+            self.__on_complete(self.__spool_file)
+            return
+
+        with self.__reader_lock:
+            self.__reader.close()
+        self.__on_discard(self.__spool_file)
+
+    def __stop_spotty(self) -> None:
+        self.__stop_process(self.__spotty_process)
+
+    @staticmethod
+    def __stop_process(spotty_process: subprocess.Popen) -> None:
+        if not spotty_process or spotty_process.poll() is not None:
+            return
+        spotty_process.terminate()
+        try:
+            spotty_process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            kill_process_by_pid(spotty_process.pid)
@@ -0,0 +1,129 @@
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Tuple, Union
+
+from xbmc import LOGDEBUG
+
+from spotty_pcm_spool import get_spool_key
+from utils import log_msg, log_exception
+
+# A warm spotty sitting on a full pipe for too long may have lost its Spotify session.
+WARM_PROCESS_MAX_AGE_IN_SECS = 600
+REFILL_CHECK_INTERVAL_IN_SECS = 60
+
+
+class SpottyWarmPool:
+    """Spotty processes started ahead of time for known upcoming tracks. A warm spotty has
+    logged in and decoded its first frames, then blocks on its full stdout pipe until a
+    track buffer takes it over."""
+
+    def __init__(self, spawn_spotty: Callable[[str, bool], subprocess.Popen]):
+        self.__spawn_spotty = spawn_spotty
+        self.__max_size = 0
+        self.__lock = threading.Lock()
+
+        # Spool key -> (process, start time) for each warm spotty.
+        self.__processes: OrderedDict[str, Tuple[subprocess.Popen, float]] = OrderedDict()
+        self.__wanted_tracks: List[Tuple[str, bool]] = []
+
+        self.__refill_needed = threading.Event()
+        self.__stopped = False
+        self.__refill_thread = threading.Thread(target=self.__refill, daemon=True)
+        self.__refill_thread.start()
+
+    def set_max_size(self, max_size: int) -> None:
+        with self.__lock:
+            if max_size == self.__max_size:
+                return
+            self.__max_size = max_size
+            self.__wanted_tracks = self.__wanted_tracks[:max_size]
+        self.__refill_needed.set()
+
+    def warm(self, tracks: List[Tuple[str, bool]]) -> None:
+        """Keep warm spotties for the first few of 'tracks' (track id, normalization flag)
+        and drop any others. The pool refills in the background."""
+        with self.__lock:
+            self.__wanted_tracks = tracks[: self.__max_size]
+        self.__refill_needed.set()
+
+    def take(self, track_id: str, use_normalization: bool) -> Union[subprocess.Popen, None]:
+        with self.__lock:
+            entry = self.__processes.pop(get_spool_key(track_id, use_normalization), None)
+            if (track_id, use_normalization) in self.__wanted_tracks:
+                self.__wanted_tracks.remove((track_id, use_normalization))
+        if not entry:
+            return None
+        self.__refill_needed.set()
+
+        process = entry[0]
+        if process.poll() is not None:
+            log_msg(f"Warm spotty for track '{track_id}' has already exited.", LOGDEBUG)
+            return None
+
+        log_msg(f"Using warm spotty for track '{track_id}'.", LOGDEBUG)
+        return process
+
+    def stop(self) -> None:
+        with self.__lock:
+            self.__stopped = True
+            self.__wanted_tracks = []
+        self.__refill_needed.set()
+        self.__refill_thread.join(5)
+
+    def __refill(self) -> None:
+        while True:
+            self.__refill_needed.wait(REFILL_CHECK_INTERVAL_IN_SECS)
+            self.__refill_needed.clear()
+            try:
+                for process in self.__get_unwanted_processes():
+                    self.__stop_process(process)
+                if self.__stopped:
+                    return
+                self.__spawn_missing_processes()
+            except Exception as exc:
+                log_exception(exc, "Error refilling warm spotty pool")
+
+    def __get_unwanted_processes(self) -> List[subprocess.Popen]:
+        with self.__lock:
+            wanted_keys = [get_spool_key(*track) for track in self.__wanted_tracks]
+            unwanted_processes = []
+            for key, (process, start_time) in list(self.__processes.items()):
+                stale = time.time() - start_time > WARM_PROCESS_MAX_AGE_IN_SECS
+                if key not in wanted_keys or stale or process.poll() is not None:
+                    unwanted_processes.append(self.__processes.pop(key)[0])
+            return unwanted_processes
+
+    def __spawn_missing_processes(self) -> None:
+        with self.__lock:
+            missing_tracks = [
+                track
+                for track in self.__wanted_tracks
+                if get_spool_key(*track) not in self.__processes
+            ]
+
+        for track_id, use_normalization in missing_tracks:
+            log_msg(f"Warming spotty for track '{track_id}'.", LOGDEBUG)
+            process = self.__spawn_spotty(track_id, use_normalization)
+            with self.__lock:
+                if self.__stopped or (track_id, use_normalization) not in self.__wanted_tracks:
+                    unwanted_process = process
+                else:
+                    self.__processes[get_spool_key(track_id, use_normalization)] = (
+                        process,
+                        time.time(),
+                    )
+                    unwanted_process = None
+            if unwanted_process:
+                self.__stop_process(unwanted_process)
+
+    @staticmethod
+    def __stop_process(process: subprocess.Popen) -> None:
+        if process.poll() is None:
+            process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        process.stdout.close()
@@ -1,8 +1,11 @@
 import inspect
+import json
 import os
 import platform
 import signal
 import unicodedata
+import urllib.error
+import urllib.request
 from traceback import format_exception
 from typing import Any, Dict, List, Tuple, Union
 
@@ -19,6 +22,13 @@ ADDON_DATA_PATH = xbmcvfs.translatePath(f"special://profile/addon_data/{ADDON_ID
 ADDON_WINDOW_ID = 10000
 
 KODI_PROPERTY_SPOTIFY_TOKEN = "spotify-token"
+# The user's profile, with the token it was fetched with. It's refetched for a new token.
+KODI_PROPERTY_SPOTIFY_USER_PROFILE = "spotify-user-profile"
+# The service's secret for this session, which the plugin sends back on private routes.
+KODI_PROPERTY_SERVICE_SECRET = "spotify-service-secret"
+SERVICE_SECRET_HEADER = "X-Spotify-Service-Secret"
+# How long the service's token endpoint waits for a first token.
+TOKEN_WAIT_TIMEOUT_IN_SECS = 5
 
 
 def log_msg(msg: str, loglevel: int = LOGDEBUG, caller_name: str = "") -> None:
@@ -97,6 +107,55 @@ def get_cached_auth_token() -> str:
     return get_cached_value_from_kodi(KODI_PROPERTY_SPOTIFY_TOKEN)
 
 
+def publish_service_secret(secret: str) -> None:
+    cache_value_in_kodi(KODI_PROPERTY_SERVICE_SECRET, secret)
+
+
+def get_service_request_headers() -> Dict[str, str]:
+    """Headers for the service's private routes, which refuse requests without them."""
+    win = xbmcgui.Window(ADDON_WINDOW_ID)
+    return {SERVICE_SECRET_HEADER: win.getProperty(KODI_PROPERTY_SERVICE_SECRET)}
+
+
+def get_service_auth_token() -> Union[str, None]:
+    """Ask the service for its token, which returns as soon as the service has one. An empty
+    string if it has none yet, None if the service could not be asked."""
+    request = urllib.request.Request(
+        f"http://localhost:{PROXY_PORT}/token", headers=get_service_request_headers()
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=TOKEN_WAIT_TIMEOUT_IN_SECS + 1) as response:
+            return json.loads(response.read())["access_token"]
+    except urllib.error.HTTPError as exc:
+        log_msg(f"Service has no auth token: {exc}", LOGERROR)
+        return ""
+    except Exception as exc:
+        log_msg(f"Could not get auth token from the service: {exc}", LOGDEBUG)
+        return None
+
+
+def get_user_profile(spotipy, auth_token: str) -> Dict[str, str]:
+    """The user's id, country and product, from 'me' once per token and shared by the service
+    and all plugin invocations."""
+    win = xbmcgui.Window(ADDON_WINDOW_ID)
+    cached_profile = win.getProperty(KODI_PROPERTY_SPOTIFY_USER_PROFILE)
+    if cached_profile:
+        profile = json.loads(cached_profile)
+        if profile["token"] == auth_token:
+            return profile
+
+    me = spotipy.me()
+    profile = {
+        "token": auth_token,
+        "id": me["id"],
+        "country": me.get("country", ""),
+        "product": me.get("product", ""),
+    }
+    win.setProperty(KODI_PROPERTY_SPOTIFY_USER_PROFILE, json.dumps(profile))
+    log_msg(f"Cached profile of user '{profile['id']}' ({profile['country']}).", LOGDEBUG)
+    return profile
+
+
 def cache_value_in_kodi(kodi_property_id: str, value: Any):
     win = xbmcgui.Window(ADDON_WINDOW_ID)
     win.setProperty(kodi_property_id, value)
@@ -117,9 +176,8 @@ def get_cached_value_from_kodi(kodi_property_id: str, wait_ms: int = 500) -> Any
 
 
 def get_user_playlists(
-    spotipy, limit: int = 50, offset: int = 0
+    spotipy, userid: str, limit: int = 50, offset: int = 0
 ) -> Tuple[List[Dict[str, Any]], List[str]]:
-    userid = spotipy.me()["id"]
     playlists = spotipy.user_playlists(userid, limit=limit, offset=offset)
 
     own_playlists = []
@@ -132,10 +190,12 @@ def get_user_playlists(
     return own_playlists, own_playlist_names
 
 
-def get_user_playlist_id(spotipy, playlist_name: str) -> Union[str, None]:
+def get_user_playlist_id(spotipy, userid: str, playlist_name: str) -> Union[str, None]:
     offset = 0
     while True:
-        own_playlists, own_playlist_names = get_user_playlists(spotipy, limit=50, offset=offset)
+        own_playlists, own_playlist_names = get_user_playlists(
+            spotipy, userid, limit=50, offset=offset
+        )
         if len(own_playlists) == 0:
             break
         for playlist in own_playlists: